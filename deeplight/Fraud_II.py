@@ -11,6 +11,7 @@ from sklearn.metrics import confusion_matrix, classification_report
 from imblearn.over_sampling import SMOTE
 import matplotlib.pyplot as plt
 import seaborn as sns
+from model_cache import cached_artifact
 
 # Generate realistic transaction data
 def generate_transaction_data(num_transactions=1000):
@@ -36,6 +37,28 @@ def generate_transaction_data(num_transactions=1000):
 
     return df
 
+# Train the scaler, SMOTE balancing and Random Forest
+def train_models(X_train, y_train):
+    # Standardize data
+    scaler = StandardScaler()
+    X_train_scaled = scaler.fit_transform(X_train)
+
+    # Balance the dataset using SMOTE (optional, if class imbalance exists)
+    smote = SMOTE(random_state=42)
+    X_train_balanced, y_train_balanced = smote.fit_resample(X_train_scaled, y_train)
+
+    # Train a Random Forest classifier
+    rf_model = RandomForestClassifier(random_state=42)
+    rf_model.fit(X_train_balanced, y_train_balanced)
+    return {'scaler': scaler, 'rf_model': rf_model}
+
+# Trained models are reused across reruns (in memory) and across sessions and restarts (model cache on disk),
+# they are only retrained when the training data or train_models change
+@st.cache_resource
+def load_models(X_train, y_train):
+    return cached_artifact('fraud_models', lambda: train_models(X_train, y_train), data=(X_train, y_train),
+                           params={'smote_random_state': 42, 'rf_random_state': 42}, code=(train_models,))
+
 def main():
     df = generate_transaction_data()
     st.write("### Generated Transaction Dataset")
@@ -81,20 +104,12 @@ def main():
     y = df['Rules-Based Fraud Flag']  # Assume rules-based flags are the target labels (for training comparison)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-    # Standardize data
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
-
-    # Balance the dataset using SMOTE (optional, if class imbalance exists)
-    smote = SMOTE()
-    X_train_balanced, y_train_balanced = smote.fit_resample(X_train_scaled, y_train)
-
-    # Train a Random Forest classifier
-    rf_model = RandomForestClassifier(random_state=42)
-    rf_model.fit(X_train_balanced, y_train_balanced)
+    # Standardize, balance and train (or load the trained models)
+    models = load_models(X_train, y_train)
+    X_test_scaled = models['scaler'].transform(X_test)
 
     # Predict using the trained model
+    rf_model = models['rf_model']
     y_pred = rf_model.predict(X_test_scaled)
 
     # Calculate confusion matrix
@@ -0,0 +1,279 @@
+# packages
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from geodesic import haversine_distance, vincenty_distance
+from main import euclidean_distance, norm_euclidean_distance, scipy_euclidean_distance, k_nearest_parallel, \
+    k_nearest_tiled
+from spatial_index import build_index
+
+# constants
+DISTANCE_FUNCTIONS = {'euclidean': euclidean_distance, 'norm_euclidean': norm_euclidean_distance,
+                      'scipy_euclidean': scipy_euclidean_distance, 'haversine': haversine_distance,
+                      'vincenty': vincenty_distance}
+INDEX_BACKENDS = {'kdtree': {'backend': 'kdtree'}, 'balltree': {'backend': 'balltree'}, 'grid': {'backend': 'grid'},
+                  'haversine_index': {'backend': 'haversine'},
+                  'vincenty_index': {'backend': 'haversine', 'refine': 'vincenty'}}
+
+
+# functions
+
+def synthetic_sold_cords(n_sold, seed=0):
+    '''
+    Function creates synthetic sold property coordinates around Seattle (the area of the housing data)
+    :param n_sold: number of sold properties (int)
+    :param seed: random seed (int)
+    :return: (latitude, longitude) in radians (n x 2 array)
+    '''
+    rng = np.random.default_rng(seed)
+    return np.radians(np.column_stack([rng.uniform(47.15, 47.80, n_sold), rng.uniform(-122.52, -121.31, n_sold)]))
+
+
+def synthetic_sold_df(n_sold, seed=0):
+    '''
+    Function creates a synthetic dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+    '''
+    cords = synthetic_sold_cords(n_sold, seed)
+    return pd.DataFrame({'id': np.arange(n_sold, dtype=np.int64), 'latitude': cords[:, 0], 'longitude': cords[:, 1]})
+
+
+def peak_rss_mb():
+    '''
+    Function returns the peak resident set size of the process so far (MB)
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KB on linux
+
+
+def time_case(knn_fun, cord1, k_nearest, repeat, warmup, latency_samples):
+    '''
+    Function times a k nearest lookup: batch throughput over repeated runs and single query latency percentiles
+    :param knn_fun: function of (m_obs_array, k_nearest) returning the k nearest indices
+    :param cord1: observed properties array (m x 2 array)
+    :param k_nearest: number of nearest properties to return (int)
+    :param repeat: number of timed batch runs (int)
+    :param warmup: number of untimed batch runs (int)
+    :param latency_samples: number of timed single observed property queries (int)
+    :return: dict of timings
+    '''
+    for _ in range(warmup):
+        knn_fun(cord1, k_nearest)
+    batch = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        knn_fun(cord1, k_nearest)
+        batch.append(time.perf_counter() - start)
+    latency = []
+    for cord in cord1[:latency_samples]:
+        start = time.perf_counter()
+        knn_fun(cord[None, :], k_nearest)
+        latency.append(time.perf_counter() - start)
+    latency_ms = np.array(latency) * 1000
+    return {'batch_seconds': {'min': min(batch), 'median': float(np.median(batch)), 'max': max(batch)},
+            'throughput_qps': len(cord1) / float(np.median(batch)),
+            'latency_ms': {f'p{p}': float(np.percentile(latency_ms, p)) for p in (50, 90, 99)}}
+
+
+def benchmark_knn(sizes, m_values, k_values, distance_functions, index_backends, repeat=5, warmup=1,
+                  latency_samples=100, memory_budget_mb=256, max_brute_force=2e9):
+    '''
+    Function benchmarks the distance functions (brute force, tiled) and spatial index backends on synthetic datasets
+    :param sizes: numbers of sold properties (list of int)
+    :param m_values: numbers of observed properties (list of int)
+    :param k_values: numbers of nearest properties (list of int)
+    :param distance_functions: names in DISTANCE_FUNCTIONS (list of str)
+    :param index_backends: names in INDEX_BACKENDS (list of str)
+    :param repeat: number of timed batch runs per case (int)
+    :param warmup: number of untimed batch runs per case (int)
+    :param latency_samples: number of timed single observed property queries per case (int)
+    :param memory_budget_mb: memory budget of a distance matrix tile for the distance functions (MB)
+    :param max_brute_force: skip distance functions when m x n exceeds this number of distances (float)
+    :return: list of dict, one per case
+    '''
+    results = []
+    for n_sold in sizes:
+        n_sold_df = synthetic_sold_df(n_sold, seed=0)
+        cord2 = n_sold_df[['latitude', 'longitude']].to_numpy()
+        cases = [(name, 'distance', None) for name in distance_functions] + \
+                [(name, 'index', INDEX_BACKENDS[name]) for name in index_backends]
+        for name, kind, index_kwargs in cases:
+            build_seconds, sold_index = None, None
+            if kind == 'index':
+                start = time.perf_counter()
+                sold_index = build_index(n_sold_df, **index_kwargs)
+                build_seconds = time.perf_counter() - start
+            for m_obs in m_values:
+                cord1 = synthetic_sold_cords(m_obs, seed=1)
+                for k_nearest in k_values:
+                    case = {'n_sold': n_sold, 'm_obs': m_obs, 'k_nearest': k_nearest, 'method': name, 'kind': kind,
+                            'build_seconds': build_seconds}
+                    if kind == 'distance' and m_obs * n_sold > max_brute_force:
+                        results.append(dict(case, skipped=f'm x n above max_brute_force ({max_brute_force:.0e})'))
+                        continue
+                    if kind == 'distance':
+                        distance_fun = DISTANCE_FUNCTIONS[name]
+                        knn_fun = lambda c, k: k_nearest_tiled(k, c, cord2, distance_fun, memory_budget_mb)
+                    else:
+                        knn_fun = sold_index.query
+                    # timed with tracing off (tracing every allocation slows the Python level code), then the
+                    # peak memory of one batch is traced in a separate untimed run
+                    case.update(time_case(knn_fun, cord1, k_nearest, repeat, warmup, latency_samples))
+                    tracemalloc.start()
+                    knn_fun(cord1, k_nearest)
+                    case['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                    tracemalloc.stop()
+                    case['peak_rss_mb'] = peak_rss_mb()
+                    results.append(case)
+                    print(f"n={n_sold} m={m_obs} k={k_nearest} {name}: {round(case['throughput_qps'], 1)} queries/s, "
+                          f"p50 {round(case['latency_ms']['p50'], 3)} ms, p99 {round(case['latency_ms']['p99'], 3)} ms")
+            del sold_index
+    return results
+
+
+def benchmark_recall(sizes, m_obs, k_values, probes_values, latency_samples=100, memory_budget_mb=256):
+    '''
+    Function measures the recall@k and latency of the approximate grid index at each number of probes against the
+    exact scipy_euclidean_distance result
+    :param sizes: numbers of sold properties (list of int)
+    :param m_obs: number of observed properties (int)
+    :param k_values: numbers of nearest properties (list of int)
+    :param probes_values: numbers of cells probed per query (list of int)
+    :param latency_samples: number of timed single observed property queries per case (int)
+    :param memory_budget_mb: memory budget of a distance matrix tile for the exact result (MB)
+    :return: list of dict, one per case
+    '''
+    results = []
+    for n_sold in sizes:
+        n_sold_df = synthetic_sold_df(n_sold, seed=0)
+        cord2 = n_sold_df[['latitude', 'longitude']].to_numpy()
+        cord1 = synthetic_sold_cords(m_obs, seed=1)
+        grid = build_index(n_sold_df, backend='grid')
+        for k_nearest in k_values:
+            _, exact = k_nearest_tiled(k_nearest, cord1, cord2, scipy_euclidean_distance, memory_budget_mb)
+            exact_ids = n_sold_df.id.to_numpy()[exact]
+            for probes in probes_values:
+                grid.probes = probes
+                _, idx = grid.query(cord1, k_nearest)
+                recall = np.mean([len(np.intersect1d(a, b)) / k_nearest for a, b in zip(grid.ids[idx], exact_ids)])
+                case = {'n_sold': n_sold, 'm_obs': m_obs, 'k_nearest': k_nearest, 'method': f'grid_probes_{probes}',
+                        'kind': 'approximate', 'probes': probes, 'recall_at_k': float(recall)}
+                case.update(time_case(grid.query, cord1, k_nearest, repeat=1, warmup=0,
+                                      latency_samples=latency_samples))
+                results.append(case)
+                print(f"n={n_sold} k={k_nearest} probes={probes}: recall@{k_nearest} {round(recall, 4)}, "
+                      f"p50 {round(case['latency_ms']['p50'], 3)} ms, p99 {round(case['latency_ms']['p99'], 3)} ms")
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.2):
+    '''
+    Function compares the throughput of each case with a baseline report
+    :param results: list of dict returned by benchmark_knn
+    :param baseline: report (dict) written by an earlier run
+    :param tolerance: allowed relative drop in throughput (float)
+    :return: list of str describing each regression
+    '''
+    key = lambda case: (case['n_sold'], case['m_obs'], case['k_nearest'], case['method'])
+    baseline_cases = {key(case): case for case in baseline['results'] if 'throughput_qps' in case}
+    regressions = []
+    for case in results:
+        before = baseline_cases.get(key(case))
+        if before and 'throughput_qps' in case and case['throughput_qps'] < (1 - tolerance) * before['throughput_qps']:
+            regressions.append(f"{case['method']} n={case['n_sold']} m={case['m_obs']} k={case['k_nearest']}: "
+                               f"{round(before['throughput_qps'], 1)} -> {round(case['throughput_qps'], 1)} queries/s")
+    return regressions
+
+
+def benchmark_workers(n_sold, m_obs, k_nearest=10, workers=(1, 2, 4, 8), distance_fun=scipy_euclidean_distance,
+                      repeat=3):
+    '''
+    Function times the parallel executor at each number of workers and reports the speedup over a single worker
+    :param n_sold: number of sold properties (int)
+    :param m_obs: number of observed properties (int)
+    :param k_nearest: number of nearest properties to return (int)
+    :param workers: numbers of worker processes to time (tuple)
+    :param distance_fun: distance function (euclidean, haversine, vincenty etc.)
+    :param repeat: number of timed runs per number of workers, the best is reported (int)
+    :return: list of dict (workers, seconds, speedup)
+    '''
+    cord2 = synthetic_sold_cords(n_sold, seed=0)
+    cord1 = synthetic_sold_cords(m_obs, seed=1)
+    results = []
+    for n_workers in workers:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            k_nearest_parallel(k_nearest, cord1, cord2, distance_fun, n_workers, memory_budget_mb=64)
+            timings.append(time.perf_counter() - start)
+        results.append({'workers': n_workers, 'seconds': min(timings), 'speedup': results[0]['seconds'] / min(timings)
+                        if results else 1.0})
+        print(f"{n_workers} workers: {round(min(timings), 3)} seconds, speedup {round(results[-1]['speedup'], 2)}x")
+    return results
+
+
+# main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='knn', choices=['knn', 'recall', 'workers'],
+                        help='benchmark the distance functions and index backends, the recall of the approximate '
+                             'grid index or the parallel executor scaling')
+    parser.add_argument('--sizes', default=[10000, 100000, 1000000, 10000000], type=int, nargs='+',
+                        help='numbers of synthetic sold properties')
+    parser.add_argument('--m', default=[1, 100, 1000], type=int, nargs='+', help='numbers of observed properties')
+    parser.add_argument('--k', default=[1, 10, 50], type=int, nargs='+', help='numbers of nearest properties')
+    parser.add_argument('--distance', default=['euclidean', 'norm_euclidean', 'scipy_euclidean', 'haversine'],
+                        choices=list(DISTANCE_FUNCTIONS), nargs='*', help='distance functions to benchmark')
+    parser.add_argument('--backend', default=list(INDEX_BACKENDS), choices=list(INDEX_BACKENDS), nargs='*',
+                        help='spatial index backends to benchmark')
+    parser.add_argument('--repeat', default=5, type=int, help='timed batch runs per case')
+    parser.add_argument('--warmup', default=1, type=int, help='untimed batch runs per case')
+    parser.add_argument('--latency-samples', default=100, type=int, help='timed single queries per case')
+    parser.add_argument('--memory-budget', default=256, type=float, help='distance matrix tile budget (MB)')
+    parser.add_argument('--max-brute-force', default=2e9, type=float, help='largest m x n run with distance functions')
+    parser.add_argument('--output', default='benchmark_report.json', type=str, help='json report')
+    parser.add_argument('--baseline', type=str, help='earlier json report to check for throughput regressions')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='allowed relative drop in throughput')
+    parser.add_argument('--probes', default=[1, 4, 9, 16, 25], type=int, nargs='+',
+                        help='numbers of cells probed by the approximate grid index')
+    parser.add_argument('--workers', default=[1, 2, 4, 8], type=int, nargs='+', help='numbers of worker processes')
+    args = parser.parse_args()
+
+    if args.command == 'workers':
+        n_sold, m_obs, k_nearest = args.sizes[0], args.m[0], args.k[0]
+        print(f"Scaling of the parallel executor ({n_sold} sold, {m_obs} observed, k={k_nearest}, {os.cpu_count()} cpus)")
+        benchmark_workers(n_sold=n_sold, m_obs=m_obs, k_nearest=k_nearest, workers=tuple(args.workers))
+        raise SystemExit
+
+    if args.command == 'recall':
+        results = benchmark_recall(sizes=args.sizes, m_obs=max(args.m), k_values=args.k, probes_values=args.probes,
+                                   latency_samples=args.latency_samples, memory_budget_mb=args.memory_budget)
+    else:
+        results = benchmark_knn(sizes=args.sizes, m_values=args.m, k_values=args.k, distance_functions=args.distance,
+                                index_backends=args.backend, repeat=args.repeat, warmup=args.warmup,
+                                latency_samples=args.latency_samples, memory_budget_mb=args.memory_budget,
+                                max_brute_force=args.max_brute_force)
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'cpus': os.cpu_count()},
+              'config': vars(args), 'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+    # python benchmark.py knn --sizes 10000 100000 1000000 10000000 --m 1 100 1000 --k 10 --output report.json
+    # python benchmark.py recall --sizes 10000 100000 1000000 --m 1000 --k 10 --probes 1 4 9 16 25
+    # python benchmark.py workers --sizes 1000000 --m 2000 --k 10 --workers 1 2 4 8
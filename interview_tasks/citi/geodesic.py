@@ -0,0 +1,92 @@
+# packages
+import numpy as np
+
+# constants
+EARTH_RADIUS_KM = 6371.0088  # mean earth radius (km)
+WGS84_A = 6378.137  # semi-major axis of the WGS-84 ellipsoid (km)
+WGS84_F = 1 / 298.257223563  # flattening of the WGS-84 ellipsoid
+WGS84_B = (1 - WGS84_F) * WGS84_A  # semi-minor axis of the WGS-84 ellipsoid (km)
+
+
+# functions
+
+def haversine_pairwise(lat1, long1, lat2, long2):
+    '''
+    Function calculates the great-circle distance on a sphere using the haversine formula
+    :param lat1, long1: latitude and longitude in radians (arrays broadcastable against lat2, long2)
+    :param lat2, long2: latitude and longitude in radians
+    :return: great-circle distance (km), elementwise
+    '''
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def vincenty_pairwise(lat1, long1, lat2, long2, tolerance=1e-12, max_iter=200):
+    '''
+    Function calculates the geodesic distance on the WGS-84 ellipsoid using Vincenty's inverse formula.
+    Pairs that do not converge (nearly antipodal points) fall back to the haversine distance
+    :param lat1, long1: latitude and longitude in radians (arrays broadcastable against lat2, long2)
+    :param lat2, long2: latitude and longitude in radians
+    :param tolerance: convergence tolerance on the longitude on the auxiliary sphere (float)
+    :param max_iter: maximum number of iterations (int)
+    :return: geodesic distance (km), elementwise
+    '''
+    lat1, long1, lat2, long2 = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (lat1, long1, lat2, long2)))
+    L = long2 - long1
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_U1, cos_U1, sin_U2, cos_U2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam) ** 2 + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)  # equatorial line
+            C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (
+                    sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) < tolerance
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+                cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+                - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = WGS84_B * A * (sigma - delta_sigma)
+
+    fallback = ~converged | ~np.isfinite(distance)
+    if fallback.any():
+        distance = np.where(fallback, haversine_pairwise(lat1, long1, lat2, long2), distance)
+    return distance
+
+
+def haversine_distance(cord1, cord2):
+    '''
+    Function calculates the great-circle distance using the haversine formula
+    :param cord1: (latitude, longitude) in radians (m x 2 array)
+    :param cord2: (latitude, longitude) in radians (n x 2 array)
+    :return: great-circle distance in km (m x n array)
+    '''
+    cord1, cord2 = np.atleast_2d(cord1), np.atleast_2d(cord2)
+    return haversine_pairwise(cord1[:, None, 0], cord1[:, None, 1], cord2[None, :, 0], cord2[None, :, 1])
+
+
+def vincenty_distance(cord1, cord2):
+    '''
+    Function calculates the geodesic distance on the WGS-84 ellipsoid using Vincenty's inverse formula
+    :param cord1: (latitude, longitude) in radians (m x 2 array)
+    :param cord2: (latitude, longitude) in radians (n x 2 array)
+    :return: geodesic distance in km (m x n array)
+    '''
+    cord1, cord2 = np.atleast_2d(cord1), np.atleast_2d(cord2)
+    return vincenty_pairwise(cord1[:, None, 0], cord1[:, None, 1], cord2[None, :, 0], cord2[None, :, 1])
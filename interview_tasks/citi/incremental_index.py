@@ -0,0 +1,198 @@
+# packages
+import pandas as pd
+import numpy as np
+import threading
+import scipy.spatial
+from geodesic import haversine_distance, vincenty_distance
+from spatial_index import build_index, check_k_nearest
+
+
+# classes
+
+class IndexState:
+    '''
+    Immutable snapshot of an incremental index. Positions are append only between compactions, a compaction drops the
+    removed properties and renumbers the positions, so positions are only valid with the ids of the snapshot queried
+    '''
+
+    def __init__(self, ids, cords, alive, base, base_positions, delta_positions):
+        self.ids = ids  # property ids of every position (p array)
+        self.cords = cords  # (latitude, longitude) of every position (p x 2 array)
+        self.alive = alive  # False for removed properties (p array)
+        self.base = base  # spatial index over base_positions, its ids are global positions (None if empty)
+        self.base_positions = base_positions  # positions indexed by the base
+        self.delta_positions = delta_positions  # positions appended since the base was built (searched by brute force)
+        self.base_dead = int(np.count_nonzero(~alive[base_positions]))  # removed properties still in the base
+        self.n_alive = int(np.count_nonzero(alive))
+
+
+class IncrementalIndex:
+    '''
+    Spatial index of the sold properties supporting appends and deletes without a full rebuild:
+    new sales go to a delta searched by brute force, removed listings are tombstoned, and once the delta and
+    tombstones grow past compact_threshold the base index is rebuilt in a background thread and swapped in
+    '''
+
+    def __init__(self, n_sold_df, backend='kdtree', compact_threshold=10000, background=True, **kwargs):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        :param backend: base index backend (kdtree, balltree, grid, haversine)
+        :param compact_threshold: number of delta and removed properties that triggers a compaction (int)
+        :param background: compact in a background thread rather than in the updating call (bool)
+        :param kwargs: keyword arguments passed to the base index backend
+        '''
+        self.backend = backend
+        self.index_kwargs = kwargs
+        self.compact_threshold = compact_threshold
+        self.background = background
+        if backend == 'haversine':  # delta distances in the units of the base index (km)
+            self.distance_fun = vincenty_distance if kwargs.get('refine') else haversine_distance
+        else:
+            self.distance_fun = lambda cord1, cord2: scipy.spatial.distance.cdist(cord1, cord2, metric='euclidean')
+        self.lock = threading.Lock()  # serialises updates, queries read self.state without locking
+        self.compaction = None
+
+        ids = n_sold_df.id.to_numpy()
+        cords = n_sold_df[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        positions = np.arange(len(ids))
+        self.state = IndexState(ids, cords, np.ones(len(ids), dtype=bool), self._build_base(cords, positions),
+                                positions, np.empty(0, dtype=np.int64))
+
+    @property
+    def ids(self):
+        return self.state.ids
+
+    def _build_base(self, cords, positions):
+        if not len(positions):
+            return None
+        # the base is built with global positions as ids, so its query results map straight back to positions
+        base_df = pd.DataFrame({'id': positions, 'latitude': cords[positions, 0], 'longitude': cords[positions, 1]})
+        return build_index(base_df, backend=self.backend, **self.index_kwargs)
+
+    def query(self, m_obs_array, k_nearest):
+        '''
+        Function returns the k nearest sold properties for a set of observed properties m
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :return: distance (m x k array), positions of the sold properties in self.ids (m x k array); a concurrent
+                 compaction renumbers the positions, use query_ids then
+        '''
+        return self._query(self.state, m_obs_array, k_nearest)
+
+    def query_ids(self, m_obs_array, k_nearest):
+        '''
+        Function returns the ids of the k nearest sold properties, read from the snapshot queried
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :return: distance (m x k array), ids of the sold properties (m x k array)
+        '''
+        state = self.state
+        distance, idx = self._query(state, m_obs_array, k_nearest)
+        return distance, state.ids[idx]
+
+    def _query(self, state, m_obs_array, k_nearest):
+        '''
+        Function returns the k nearest live properties of a snapshot, positions in state.ids
+        '''
+        check_k_nearest(k_nearest, state.n_alive)
+        m_obs_array = np.atleast_2d(m_obs_array)
+        distance = np.empty((len(m_obs_array), 0))
+        idx = np.empty((len(m_obs_array), 0), dtype=np.int64)
+        if state.base is not None:
+            # enough base neighbours that k remain once the removed properties are dropped
+            k_base = min(k_nearest + state.base_dead, len(state.base_positions))
+            distance, local = state.base.query(m_obs_array, k_base)
+            idx = state.base.ids[local]
+            distance = np.where(state.alive[idx], distance, np.inf)
+        delta = state.delta_positions[state.alive[state.delta_positions]]
+        if len(delta):
+            distance = np.concatenate([distance, self.distance_fun(m_obs_array, state.cords[delta])], axis=1)
+            idx = np.concatenate([idx, np.broadcast_to(delta, (len(m_obs_array), len(delta)))], axis=1)
+        top = np.argpartition(distance, k_nearest - 1, axis=1)[:, :k_nearest]
+        distance, idx = np.take_along_axis(distance, top, axis=1), np.take_along_axis(idx, top, axis=1)
+        order = np.argsort(distance, axis=1)
+        return np.take_along_axis(distance, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+    def append(self, new_sold_df):
+        '''
+        Function adds newly sold properties; a property id already in the index, or repeated in the batch, is replaced
+        by its last sale
+        :param new_sold_df: dataframe of (new sold properties) by (id, latitude, longitude) (x 3 dataframe)
+        '''
+        new_sold_df = new_sold_df.drop_duplicates(subset='id', keep='last')
+        new_ids = new_sold_df.id.to_numpy()
+        new_cords = new_sold_df[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        with self.lock:
+            state = self.state
+            alive = state.alive & ~np.isin(state.ids, new_ids)
+            positions = np.arange(len(state.ids), len(state.ids) + len(new_ids))
+            self.state = IndexState(np.concatenate([state.ids, new_ids]), np.concatenate([state.cords, new_cords]),
+                                    np.concatenate([alive, np.ones(len(new_ids), dtype=bool)]), state.base,
+                                    state.base_positions, np.concatenate([state.delta_positions, positions]))
+        self._maybe_compact()
+
+    def delete(self, removed_ids):
+        '''
+        Function removes properties from the index (e.g. withdrawn listings)
+        :param removed_ids: property ids to remove (list or array)
+        '''
+        with self.lock:
+            state = self.state
+            alive = state.alive & ~np.isin(state.ids, np.asarray(removed_ids))
+            self.state = IndexState(state.ids, state.cords, alive, state.base, state.base_positions,
+                                    state.delta_positions)
+        self._maybe_compact()
+
+    def apply_delta_file(self, filename):
+        '''
+        Function applies a delta file of new sales and removed listings with columns id, lat, long (decimal degrees)
+        and an optional action column (add, remove), rows without an action are added
+        :param filename: path of the delta csv (str)
+        '''
+        delta_df = pd.read_csv(filename, sep=',', header=0)
+        action = delta_df['action'].fillna('add') if 'action' in delta_df else pd.Series('add', index=delta_df.index)
+        removed = delta_df.loc[action == 'remove', 'id']
+        if len(removed):
+            self.delete(removed.to_numpy())
+        added = delta_df.loc[action == 'add']
+        if len(added):
+            self.append(pd.DataFrame({'id': added['id'].to_numpy(),
+                                      'latitude': np.radians(added['lat'].to_numpy(dtype=np.float64)),
+                                      'longitude': np.radians(added['long'].to_numpy(dtype=np.float64))}))
+
+    def live_frame(self):
+        '''
+        Function returns the sold properties currently in the index
+        :return: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        '''
+        state = self.state
+        return pd.DataFrame({'id': state.ids[state.alive],
+                             'latitude': state.cords[state.alive, 0],
+                             'longitude': state.cords[state.alive, 1]})
+
+    def _maybe_compact(self):
+        state = self.state
+        if len(state.delta_positions) + state.base_dead < self.compact_threshold:
+            return
+        if not self.background:
+            self.compact()
+        elif self.compaction is None or not self.compaction.is_alive():
+            self.compaction = threading.Thread(target=self.compact, daemon=True)
+            self.compaction.start()
+
+    def compact(self):
+        '''
+        Function rebuilds the base index over the live properties only and swaps it in: the removed properties are
+        dropped and the positions renumbered, so ids and cords do not grow under delete / re-append churn. Updates
+        made while the base is rebuilt stay in the delta / tombstones of the new snapshot
+        '''
+        snapshot = self.state
+        live = np.flatnonzero(snapshot.alive)
+        positions = np.arange(len(live))
+        base = self._build_base(snapshot.cords[live], positions)
+        with self.lock:
+            state = self.state
+            appended = np.arange(len(snapshot.ids), len(state.ids))  # positions appended during the rebuild
+            keep = np.concatenate([live, appended])
+            self.state = IndexState(state.ids[keep], state.cords[keep], state.alive[keep], base, positions,
+                                    np.arange(len(live), len(keep)))
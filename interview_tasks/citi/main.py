@@ -6,40 +6,72 @@ import os
 import time
 import scipy.spatial
 import math
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, update_wrapper
+from incremental_index import IncrementalIndex
+from sales_index import build_sales_index_file, open_sales_index, sold_properties_frame
+from geodesic import haversine_distance, vincenty_distance
+from spatial_index import INDEX_BACKENDS, build_index, check_k_nearest
 
 
 # functions
 
-def euclidean_distance(cord1, cord2):
+def euclidean_distance(cord1, cord2, dtype=np.float64):
     '''
-    Function calculates the euclidean distance using Pythagorean theorem
+    Function calculates the euclidean distance using Pythagorean theorem, broadcasting the coordinate differences
     :param cord1: (latitude, longitude) (m x 2 array)
     :param cord2: (latitude, longitude) (n x 2 array)
+    :param dtype: floating point precision of the calculation (np.float64, np.float32)
     :return: euclidean distance (m x n array)
     '''
-    euclidean_function = lambda cord1, cord2: np.sqrt(np.sum((cord1 - cord2) ** 2, axis=1))
-    return np.apply_along_axis(func1d=euclidean_function, axis=1, arr=cord1, cord2=cord2)
+    centre = np.mean(cord2, axis=0)  # centred coordinates keep float32 precision on the differences
+    cord1, cord2 = np.asarray(cord1 - centre, dtype=dtype), np.asarray(cord2 - centre, dtype=dtype)
+    squared = np.zeros((len(cord1), len(cord2)), dtype=dtype)
+    for axis in range(cord1.shape[1]):  # one m x n pass per coordinate rather than an m x n x 2 difference array
+        squared += (cord1[:, axis, None] - cord2[None, :, axis]) ** 2
+    return np.sqrt(squared, out=squared)
 
 
-def norm_euclidean_distance(cord1, cord2):
+def norm_euclidean_distance(cord1, cord2, dtype=np.float64):
     '''
-    Function calculates the euclidean distance using the L1 norm
+    Function calculates the euclidean distance using the norms and a matrix multiply: ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab.
+    Coordinates are centred first to limit cancellation and the squared distance is clamped at zero
     :param cord1: (latitude, longitude) (m x 2 array)
     :param cord2: (latitude, longitude) (n x 2 array)
-    :return: euclidean distance (n x n array)
+    :param dtype: floating point precision of the calculation (np.float64, np.float32)
+    :return: euclidean distance (m x n array)
     '''
-    euclidean_function = lambda cord1, cord2: np.linalg.norm(cord1 - cord2, axis=1)
-    return np.apply_along_axis(func1d=euclidean_function, axis=1, arr=cord1, cord2=cord2)
+    centre = np.mean(cord2, axis=0)
+    cord1, cord2 = np.asarray(cord1 - centre, dtype=dtype), np.asarray(cord2 - centre, dtype=dtype)
+    squared = cord1 @ cord2.T  # ab (BLAS)
+    squared *= -2
+    squared += np.einsum('ij,ij->i', cord1, cord1)[:, None]  # ||a||^2
+    squared += np.einsum('ij,ij->i', cord2, cord2)[None, :]  # ||b||^2
+    np.maximum(squared, 0, out=squared)  # clamp rounding below zero
+    return np.sqrt(squared, out=squared)
 
 
-def scipy_euclidean_distance(cord1, cord2):
+def scipy_euclidean_distance(cord1, cord2, dtype=np.float64):
     '''
     Function calculates the euclidean distance using scipy,spatial module
     :param cord1: (latitude, longitude) (m x 2 array)
     :param cord2: (latitude, longitude) (n x 2 array)
+    :param dtype: floating point precision of the result (scipy calculates in np.float64)
     :return: euclidean distance (m x n array)
     '''
-    return scipy.spatial.distance.cdist(XA=cord1, XB=cord2, metric='euclidean')
+    return scipy.spatial.distance.cdist(XA=cord1, XB=cord2, metric='euclidean').astype(dtype, copy=False)
+
+
+def with_dtype(distance_fun, dtype):
+    '''
+    Function fixes the floating point precision of a distance function, keeping the distance_fun interface
+    :param distance_fun: distance function taking a dtype argument (euclidean_distance, norm_euclidean_distance etc.)
+    :param dtype: floating point precision of the calculation (np.float64, np.float32)
+    :return: distance function of (cord1, cord2)
+    '''
+    return update_wrapper(partial(distance_fun, dtype=dtype), distance_fun)
 
 
 def load_sales_df(filepath, filename):
@@ -51,26 +83,169 @@ def load_sales_df(filepath, filename):
     return pd.read_csv(filepath_or_buffer=os.path.join(filepath, filename), sep=',', header=0)
 
 
-def return_k_nearest_sold_properties(k_nearest, m_obs_array, n_sold_df, distance_fun):
+_bytes_per_cell = {}  # measured once per distance function
+
+
+def distance_bytes_per_cell(distance_fun, cord1, cord2, probe_rows=16, probe_cols=1024):
+    '''
+    Function measures the peak memory a distance function allocates per cell of its distance matrix (the output and
+    every m x n temporary), on a small probe tile traced with tracemalloc. The measure is cached per distance function,
+    so later calls do not reset the peak of a caller already tracing
+    :param distance_fun: distance function (euclidean, haversine, vincenty etc.)
+    :param cord1: observed properties array (m x 2 array)
+    :param cord2: sold properties array (n x 2 array)
+    :return: bytes per cell (float)
+    '''
+    if distance_fun in _bytes_per_cell:
+        return _bytes_per_cell[distance_fun]
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        distance = distance_fun(cord1[:probe_rows], cord2[:probe_cols])
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    _bytes_per_cell[distance_fun] = max(peak / max(distance.size, 1), distance.itemsize)
+    return _bytes_per_cell[distance_fun]
+
+
+def k_nearest_tiled(k_nearest, cord1, cord2, distance_fun, memory_budget_mb):
+    '''
+    Function returns the k nearest sold properties by streaming tiles of the distance matrix under a memory budget,
+    merging the running top k of each tile so peak memory is O(tile + m x k) rather than O(m x n)
+    :param k_nearest: number of nearest properties to return (int)
+    :param cord1: observed properties array (m x 2 array)
+    :param cord2: sold properties array (n x 2 array)
+    :param distance_fun: distance function (euclidean, haversine, vincenty etc.)
+    :param memory_budget_mb: peak memory budget of a distance matrix tile, temporaries included (MB)
+    :return: distance (m x k array), indices of the k nearest sold properties in cord2 (m x k array)
+    '''
+    m, n = len(cord1), len(cord2)
+    check_k_nearest(k_nearest, n)
+    # bytes of a tile cell: the distance matrix with the temporaries of distance_fun, and the int64 argpartition indices
+    bytes_per_cell = distance_bytes_per_cell(distance_fun, cord1, cord2) + np.dtype(np.int64).itemsize
+    tile_size = max(int(memory_budget_mb * 2 ** 20 // bytes_per_cell), k_nearest)  # cells per tile
+    n_tile = min(n, max(k_nearest, tile_size // min(m, 1024)))  # tile over n first ...
+    m_tile = max(1, min(m, tile_size // n_tile))  # ... then over m with the remaining budget
+
+    best_distance = np.full((m, k_nearest), np.inf)
+    best_idx = np.zeros((m, k_nearest), dtype=np.int64)
+    for i in range(0, m, m_tile):
+        rows = slice(i, i + m_tile)
+        for j in range(0, n, n_tile):
+            distance = distance_fun(cord1[rows], cord2[j:j + n_tile])  # distance tile (m_tile x n_tile array)
+            idx = np.broadcast_to(np.arange(j, j + distance.shape[1]), distance.shape)
+            if distance.shape[1] > k_nearest:  # top k of the tile
+                top = np.argpartition(distance, k_nearest - 1, axis=1)[:, :k_nearest]
+                distance, idx = np.take_along_axis(distance, top, axis=1), np.take_along_axis(idx, top, axis=1)
+            # merge the tile top k into the running top k
+            merged_distance = np.concatenate([best_distance[rows], distance], axis=1)
+            merged_idx = np.concatenate([best_idx[rows], idx], axis=1)
+            top = np.argpartition(merged_distance, k_nearest - 1, axis=1)[:, :k_nearest]
+            best_distance[rows] = np.take_along_axis(merged_distance, top, axis=1)
+            best_idx[rows] = np.take_along_axis(merged_idx, top, axis=1)
+    return best_distance, best_idx
+
+
+def _attach_sold_cords(filename):
+    '''
+    Function memory-maps the sold properties array once per worker process of the parallel executor
+    '''
+    global _sold_cords
+    _sold_cords = np.load(filename, mmap_mode='r')
+
+
+def _k_nearest_shard(cord1, k_nearest, distance_fun, memory_budget_mb):
+    '''
+    Function returns the indices of the k nearest sold properties for a shard of the observed properties
+    '''
+    if memory_budget_mb is not None:
+        return k_nearest_tiled(k_nearest, cord1, _sold_cords, distance_fun, memory_budget_mb)[1]
+    distance = distance_fun(cord1, _sold_cords)  # calculate distance (m_shard x n array)
+    return np.argpartition(distance, k_nearest - 1, axis=1)[:, :k_nearest]
+
+
+def k_nearest_parallel(k_nearest, cord1, cord2, distance_fun, workers, memory_budget_mb=None):
+    '''
+    Function returns the k nearest sold properties by sharding the observed properties across a process pool.
+    The sold properties are written once to a memory-mapped .npy file shared by the workers rather than pickled per task
+    :param k_nearest: number of nearest properties to return (int)
+    :param cord1: observed properties array (m x 2 array)
+    :param cord2: sold properties array (n x 2 array)
+    :param distance_fun: distance function (euclidean, haversine, vincenty etc.), defined at module level
+    :param workers: number of worker processes (int)
+    :param memory_budget_mb: memory budget of a distance matrix tile per worker (MB), all at once if None
+    :return: indices of the k nearest sold properties in cord2, in the order of cord1 (m x k array)
+    '''
+    shards = np.array_split(cord1, min(len(cord1), workers * 4))  # several shards per worker to balance the load
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'sold_cords.npy')
+        np.save(filename, np.ascontiguousarray(cord2))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_sold_cords, initargs=(filename,)) as executor:
+            idx = executor.map(partial(_k_nearest_shard, k_nearest=k_nearest, distance_fun=distance_fun,
+                                       memory_budget_mb=memory_budget_mb), shards)  # results in shard order
+            return np.concatenate(list(idx))
+
+
+def return_k_nearest_sold_properties(k_nearest, m_obs_array, n_sold_df, distance_fun, memory_budget_mb=None,
+                                     workers=1, verbose=True):
     '''
     Function that returns the IDs of the k nearest sold properties for a set of observed properties m
     :param k_nearest: number of nearest properties to return (int)
     :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
     :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
     :param distance_fun: distance function (euclidean, haversine, vincenty etc.)
+    :param memory_budget_mb: stream the distance matrix in tiles of at most this size (MB), all at once if None
+    :param workers: number of worker processes the observed properties are sharded across (int)
+    :param verbose: print the processing time (bool)
     :return: array containing id of the k nearest sold properties for each observed property m (m x k list)
     '''
 
+    check_k_nearest(k_nearest, len(n_sold_df))
     start = time.perf_counter() * 1000  # start timer
     cord1 = m_obs_array  # observed properties array (m x 2 array)
     cord2 = n_sold_df[['latitude', 'longitude']].to_numpy() # sold properties array (n x 2 array)
-    distance = distance_fun(cord1, cord2).T # calculate distance  (m x n array)
-    idx = np.argpartition(distance, k_nearest, axis=0)  # indices
     ids = n_sold_df.id.to_numpy() # property ids
-    ids_idx = np.take(a=ids, indices=idx[:k_nearest].T) # partition property ids by indices
+    if workers > 1:
+        idx = k_nearest_parallel(k_nearest, cord1, cord2, distance_fun, workers, memory_budget_mb)  # (m x k array)
+        ids_idx = np.take(a=ids, indices=idx)
+    elif memory_budget_mb is None:
+        distance = distance_fun(cord1, cord2).T # calculate distance  (m x n array)
+        idx = np.argpartition(distance, k_nearest - 1, axis=0)  # indices, the k nearest first
+        ids_idx = np.take(a=ids, indices=idx[:k_nearest].T) # partition property ids by indices
+    else:
+        _, idx = k_nearest_tiled(k_nearest, cord1, cord2, distance_fun, memory_budget_mb)  # indices (m x k array)
+        ids_idx = np.take(a=ids, indices=idx)
     end = time.perf_counter() * 1000 # end timer
 
-    print(f"Processing time ({distance_fun.__name__} distance function): {round(end - start, 5)} milliseconds")
+    if verbose:
+        print(f"Processing time ({distance_fun.__name__} distance function): {round(end - start, 5)} milliseconds")
+
+    return ids_idx
+
+
+def return_k_nearest_sold_properties_index(k_nearest, m_obs_array, sold_index):
+    '''
+    Function that returns the IDs of the k nearest sold properties for a set of observed properties m using a spatial index
+    :param k_nearest: number of nearest properties to return (int)
+    :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+    :param sold_index: spatial index of the sold properties (KDTreeIndex, BallTreeIndex, GridIndex)
+    :return: array containing id of the k nearest sold properties for each observed property m (m x k list)
+    '''
+
+    start = time.perf_counter() * 1000  # start timer
+    if isinstance(sold_index, IncrementalIndex):  # ids of the snapshot queried, a compaction renumbers the indices
+        _, ids_idx = sold_index.query_ids(m_obs_array, k_nearest)
+    else:
+        _, idx = sold_index.query(m_obs_array, k_nearest)  # indices of the k nearest (m x k array)
+        ids_idx = np.take(a=sold_index.ids, indices=idx)  # property ids by indices
+    end = time.perf_counter() * 1000  # end timer
+
+    print(f"Processing time ({type(sold_index).__name__} spatial index): {round(end - start, 5)} milliseconds")
 
     return ids_idx
 
@@ -78,37 +253,87 @@ def return_k_nearest_sold_properties(k_nearest, m_obs_array, n_sold_df, distance
 # main
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', default='query', choices=['query', 'build-index'],
+                        help='query the nearest sold properties or (re)build the sales index file')
     parser.add_argument('--path', default=os.getcwd(), type=str, help='filepath for sale information')
     parser.add_argument('--file', default='sales.csv', type=str, help='filename for sale information')
+    parser.add_argument('--index-file', type=str, help='sales index file (default <file>.idx next to the sale information)')
+    parser.add_argument('--verify-hash', action='store_true', help='rebuild the sales index file if the csv hash changed')
     parser.add_argument('--lat', type=float, nargs='+', help='latitude decimal coordinate(s)')
     parser.add_argument('--long', type=float, nargs='+', help='longitude decimal coordinate(s)')
+    parser.add_argument('--memory-budget', type=float, help='stream the distance matrix in tiles of at most this size (MB)')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='floating point precision of the euclidean distance functions')
+    parser.add_argument('--workers', default=1, type=int, help='number of worker processes for the distance functions')
+    parser.add_argument('--index', choices=list(INDEX_BACKENDS), help='spatial index backend for the sold properties')
+    parser.add_argument('--refine', choices=['vincenty'], help='refinement stage for the haversine spatial index')
+    parser.add_argument('--probes', type=int, help='approximate grid index search: number of cells probed per query')
+    parser.add_argument('--delta', type=str, nargs='+', help='delta file(s) of new sales and removed listings to apply')
     args = parser.parse_args()
 
-    sales_df = load_sales_df(filepath=args.path, filename=args.file)
-    sales_df['latitude'] = sales_df.loc[:, 'lat'].map(lambda x: math.radians(x))
-    sales_df['longitude'] = sales_df.loc[:, 'long'].map(lambda x: math.radians(x))
-    n_sold_df = sales_df[['id', 'latitude', 'longitude']]
+    csv_file = os.path.join(args.path, args.file)
+    if args.command == 'build-index':
+        sales_index = build_sales_index_file(csv_file, args.index_file)
+        print(f"Sales index of {len(sales_index.ids)} sold properties written for {csv_file}")
+        raise SystemExit
+
+    # memory-mapped sales index (rebuilt when the sale information changed)
+    sales_index = open_sales_index(csv_file, args.index_file, verify_hash=args.verify_hash)
+    n_sold_df = sold_properties_frame(sales_index)
+    if args.delta:
+        index_kwargs = {'refine': args.refine} if args.index == 'haversine' else \
+            {'probes': args.probes} if args.index == 'grid' else {}
+        sold_index = IncrementalIndex(n_sold_df, backend=args.index or 'kdtree', **index_kwargs)
+        for delta_file in args.delta:
+            sold_index.apply_delta_file(delta_file)
+        n_sold_df = sold_index.live_frame()
     m_obs_array = np.array(list(zip(map(lambda x: math.radians(x), args.lat),
                                     map(lambda x: math.radians(x), args.long))))
 
     ids1 = return_k_nearest_sold_properties(k_nearest=10,
                                             m_obs_array=m_obs_array,
                                             n_sold_df=n_sold_df,
-                                            distance_fun=euclidean_distance)
+                                            distance_fun=with_dtype(euclidean_distance, args.dtype),
+                                            memory_budget_mb=args.memory_budget,
+                                            workers=args.workers)
     print(ids1)
 
     ids2 = return_k_nearest_sold_properties(k_nearest=10,
                                             m_obs_array=m_obs_array,
                                             n_sold_df=n_sold_df,
-                                            distance_fun=norm_euclidean_distance)
+                                            distance_fun=with_dtype(norm_euclidean_distance, args.dtype),
+                                            memory_budget_mb=args.memory_budget,
+                                            workers=args.workers)
     print(ids2)
 
     ids3 = return_k_nearest_sold_properties(k_nearest=10,
                                             m_obs_array=m_obs_array,
                                             n_sold_df=n_sold_df,
-                                            distance_fun=scipy_euclidean_distance)
+                                            distance_fun=with_dtype(scipy_euclidean_distance, args.dtype),
+                                            memory_budget_mb=args.memory_budget,
+                                            workers=args.workers)
     print(ids3)
 
+    if args.index:
+        index_kwargs = {'refine': args.refine} if args.index == 'haversine' else {}
+        sales_index.probes = args.probes
+        if not args.delta:
+            sold_index = sales_index if args.index == 'grid' else build_index(n_sold_df, backend=args.index,
+                                                                               **index_kwargs)
+        ids4 = return_k_nearest_sold_properties_index(k_nearest=10,
+                                                      m_obs_array=m_obs_array,
+                                                      sold_index=sold_index)
+        print(ids4)
+        # parity with the brute force path of the same metric (ids are compared as sets per observed property)
+        if args.index == 'haversine':
+            ids3 = return_k_nearest_sold_properties(k_nearest=10,
+                                                    m_obs_array=m_obs_array,
+                                                    n_sold_df=n_sold_df,
+                                                    distance_fun=vincenty_distance if args.refine else haversine_distance,
+                                                    memory_budget_mb=args.memory_budget,
+                                                    workers=args.workers)
+        print(np.sort(ids3, axis=1) == np.sort(ids4, axis=1))
+
     # Check (47.5112, -122.257)
     # cord1 = m_obs_array[0]
     # cord2 = n_sold_df[['latitude', 'longitude']].to_numpy()
@@ -1,24 +1,244 @@
 # packages
-import pandas as pd
 import numpy as np
 import argparse
-import random
 import math
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from statistics import NormalDist
+from scipy.stats import qmc
+import time
 
-n = 10000
-radius = 1
+# constants
+VARIANCE_REDUCTION_MODES = ['plain', 'antithetic', 'stratified', 'sobol', 'halton']
 
-x = np.array([(random.randrange(0, 10000, 1)/10000 - 0.5) * 2 for i in range(n)])
-y = np.array([(random.randrange(0, 10000, 1)/10000 - 0.5) * 2 for i in range(n)])
-euclidean_function = lambda x, y: np.sqrt(x**2 + y**2)
-distance_from_origin = euclidean_function(x, y)
 
-circle_counter = np.where(distance_from_origin <= radius, 1, 0)
+# functions
 
-pi_estimate = (np.sum(circle_counter) / n) * 4
+def count_in_circle(rng, n_samples, chunk_size=2 ** 20):
+    '''
+    Function counts the uniform samples of the square [-1, 1] x [-1, 1] that fall inside the unit circle,
+    drawing the samples in vectorized chunks so memory stays constant whatever the number of samples
+    :param rng: random number generator (np.random.Generator)
+    :param n_samples: number of samples (int)
+    :param chunk_size: number of samples drawn at once (int)
+    :return: number of samples inside the unit circle (int)
+    '''
+    hits = 0
+    remaining = n_samples
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        x = rng.uniform(-1, 1, size)
+        y = rng.uniform(-1, 1, size)
+        hits += int(np.count_nonzero(x * x + y * y <= 1))
+        remaining -= size
+    return hits
 
-#print(x)
-#print(distance_from_origin)
-#print(np.sum(circle_counter))
-#print(circle_counter)
-print(pi_estimate)
+
+def _count_block(seed_seq, n_samples, chunk_size):
+    '''
+    Function counts the hits of one block of samples drawn from its own independent random stream
+    '''
+    return count_in_circle(np.random.default_rng(seed_seq), n_samples, chunk_size), n_samples
+
+
+def pi_confidence_interval(hits, n_samples, confidence=0.95):
+    '''
+    Function returns the estimate of pi and its confidence interval from the proportion of samples inside the circle
+    :param hits: number of samples inside the unit circle (int)
+    :param n_samples: number of samples (int)
+    :param confidence: confidence level of the interval (float)
+    :return: estimate, standard error, (lower, upper)
+    '''
+    p = hits / n_samples
+    estimate = 4 * p
+    standard_error = 4 * math.sqrt(p * (1 - p) / n_samples)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return estimate, standard_error, (estimate - z * standard_error, estimate + z * standard_error)
+
+
+def stream_pi_estimate(n_samples, workers=1, block_size=10 ** 8, chunk_size=2 ** 20, seed=None, confidence=0.95):
+    '''
+    Function estimates pi from the ratio of the area of a unit circle to the area of its enclosing square, yielding the
+    running estimate as each block of samples completes. Each block draws from an independent stream spawned from one
+    seed, so the final estimate for a seed does not depend on the number of workers
+    :param n_samples: total number of samples (int, up to ~1e10 and beyond)
+    :param workers: number of worker processes (int)
+    :param block_size: number of samples per task (int)
+    :param chunk_size: number of samples drawn at once within a task (int)
+    :param seed: random seed (int), fresh entropy if None
+    :param confidence: confidence level of the interval (float)
+    :return: generator of dict (samples, estimate, standard_error, interval)
+    '''
+    blocks = [block_size] * (n_samples // block_size) + ([n_samples % block_size] if n_samples % block_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    hits, done = 0, 0
+
+    def running(block_hits, block_samples):
+        nonlocal hits, done
+        hits, done = hits + block_hits, done + block_samples
+        estimate, standard_error, interval = pi_confidence_interval(hits, done, confidence)
+        return {'samples': done, 'estimate': estimate, 'standard_error': standard_error, 'interval': interval}
+
+    if workers <= 1:
+        for seed_seq, size in zip(seeds, blocks):
+            yield running(*_count_block(seed_seq, size, chunk_size))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = iter(zip(seeds, blocks))
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:  # bounded number of queued tasks
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.add(executor.submit(_count_block, task[0], task[1], chunk_size))
+            if not pending:
+                return
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield running(*future.result())
+
+
+def estimate_pi(n_samples, workers=1, block_size=10 ** 8, chunk_size=2 ** 20, seed=None, confidence=0.95):
+    '''
+    Function estimates pi (see stream_pi_estimate)
+    :return: dict (samples, estimate, standard_error, interval)
+    '''
+    result = None
+    for result in stream_pi_estimate(n_samples, workers, block_size, chunk_size, seed, confidence):
+        pass
+    return result
+
+
+def sample_batch(rng, mode='plain', batch_size=2 ** 16):
+    '''
+    Function estimates pi from one batch of samples of the unit square [0, 1] x [0, 1] (quarter circle)
+    :param rng: random number generator (np.random.Generator)
+    :param mode: sampling mode (plain, antithetic, stratified, sobol, halton)
+    :param batch_size: number of samples (int), rounded down to a power of 2 for sobol and to 2 x s^2 for stratified
+    :return: number of samples, estimate, variance of the estimate (None for the quasi-random modes, whose
+             variance is estimated across independently scrambled batches)
+    '''
+    inside = lambda u, v: (u * u + v * v <= 1).astype(float)
+    if mode == 'plain':
+        f = inside(rng.random(batch_size), rng.random(batch_size))
+        return batch_size, 4 * f.mean(), 16 * f.var(ddof=1) / batch_size
+    if mode == 'antithetic':
+        u, v = rng.random(batch_size // 2), rng.random(batch_size // 2)
+        g = (inside(u, v) + inside(1 - u, 1 - v)) / 2  # negatively correlated pair
+        return 2 * len(g), 4 * g.mean(), 16 * g.var(ddof=1) / len(g)
+    if mode == 'stratified':
+        strata = max(int(math.sqrt(batch_size / 2)), 1)  # strata x strata grid, 2 samples per stratum
+        i, j = np.divmod(np.repeat(np.arange(strata * strata), 2), strata)
+        f = inside((i + rng.random(len(i))) / strata, (j + rng.random(len(j))) / strata).reshape(-1, 2)
+        stratum_variance = f.var(axis=1, ddof=1) / 2  # variance of each stratum mean
+        return f.size, 4 * f.mean(), 16 * stratum_variance.sum() / len(f) ** 2
+    if mode == 'sobol':
+        points = qmc.Sobol(d=2, scramble=True, seed=rng).random_base2(max(int(math.log2(batch_size)), 1))
+        return len(points), 4 * inside(points[:, 0], points[:, 1]).mean(), None
+    if mode == 'halton':
+        points = qmc.Halton(d=2, scramble=True, seed=rng).random(batch_size)
+        return len(points), 4 * inside(points[:, 0], points[:, 1]).mean(), None
+    raise ValueError(f"Unknown mode '{mode}', expected one of {VARIANCE_REDUCTION_MODES}")
+
+
+def estimate_pi_to_tolerance(tolerance, mode='plain', batch_size=2 ** 16, max_samples=10 ** 10, min_batches=4,
+                             seed=None, confidence=0.95):
+    '''
+    Function keeps sampling batches until the standard error of the estimate of pi falls below the tolerance
+    :param tolerance: target standard error (float)
+    :param mode: sampling mode (plain, antithetic, stratified, sobol, halton)
+    :param batch_size: number of samples per batch (int)
+    :param max_samples: stop after this many samples even if the tolerance is not reached (int)
+    :param min_batches: minimum number of batches before stopping (int, at least 2 for the quasi-random modes)
+    :param seed: random seed (int), fresh entropy if None
+    :param confidence: confidence level of the interval (float)
+    :return: dict (mode, samples, batches, estimate, standard_error, interval, converged)
+    '''
+    rng = np.random.default_rng(seed)
+    estimates, variances, samples = [], [], 0
+    while True:
+        n, estimate, variance = sample_batch(rng, mode, batch_size)
+        samples += n
+        estimates.append(estimate)
+        variances.append(variance)
+        batches = len(estimates)
+        if variance is None:  # independent randomised quasi-random replicates
+            standard_error = np.std(estimates, ddof=1) / math.sqrt(batches) if batches > 1 else math.inf
+        else:  # equal sized independent batches
+            standard_error = math.sqrt(sum(variances)) / batches
+        converged = batches >= max(min_batches, 2) and standard_error <= tolerance
+        if converged or samples >= max_samples:
+            break
+    estimate = float(np.mean(estimates))
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return {'mode': mode, 'samples': samples, 'batches': batches, 'estimate': estimate,
+            'standard_error': float(standard_error), 'converged': converged,
+            'interval': (estimate - z * standard_error, estimate + z * standard_error)}
+
+
+def benchmark_modes(tolerance, modes=VARIANCE_REDUCTION_MODES, repeat=10, batch_size=2 ** 12, seed=0):
+    '''
+    Function benchmarks the number of samples each sampling mode needs to reach the tolerance
+    :param tolerance: target standard error (float)
+    :param modes: sampling modes (list of str)
+    :param repeat: number of runs per mode (int)
+    :param batch_size: number of samples per batch (int)
+    :param seed: random seed (int)
+    :return: list of dict (mode, mean samples, mean absolute error, mean seconds)
+    '''
+    results = []
+    for mode in modes:
+        runs = []
+        for seed_seq in np.random.SeedSequence(seed).spawn(repeat):
+            start = time.perf_counter()
+            result = estimate_pi_to_tolerance(tolerance, mode=mode, batch_size=batch_size, seed=seed_seq)
+            runs.append((result['samples'], abs(result['estimate'] - math.pi), time.perf_counter() - start))
+        samples, error, seconds = np.mean(runs, axis=0)
+        results.append({'mode': mode, 'samples': samples, 'abs_error': error, 'seconds': seconds})
+        print(f"{mode}: {samples:.0f} samples to standard error {tolerance} "
+              f"(mean absolute error {error:.2e}, {seconds:.3f} seconds)")
+    return results
+
+
+# main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', default=10000, type=float, help='number of samples (e.g. 1e10)')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='number of worker processes')
+    parser.add_argument('--block-size', default=1e8, type=float, help='number of samples per task')
+    parser.add_argument('--chunk-size', default=2 ** 20, type=int, help='number of samples drawn at once')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--confidence', default=0.95, type=float, help='confidence level of the interval')
+    parser.add_argument('--tolerance', type=float, help='sample in batches until the standard error is below this')
+    parser.add_argument('--mode', default='plain', choices=VARIANCE_REDUCTION_MODES, help='variance reduction mode')
+    parser.add_argument('--max-samples', default=1e10, type=float, help='sample budget of --tolerance')
+    parser.add_argument('--batch-size', default=2 ** 16, type=int, help='number of samples per batch (--tolerance)')
+    parser.add_argument('--benchmark', action='store_true', help='samples to --tolerance for each mode')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_modes(args.tolerance or 1e-3, batch_size=args.batch_size, seed=args.seed or 0)
+        raise SystemExit
+
+    if args.tolerance:
+        result = estimate_pi_to_tolerance(args.tolerance, mode=args.mode, batch_size=args.batch_size,
+                                          max_samples=int(args.max_samples),
+                                          seed=args.seed, confidence=args.confidence)
+        lower, upper = result['interval']
+        print(f"{result['samples']} samples ({args.mode}): pi ~ {result['estimate']:.8f} "
+              f"(standard error {result['standard_error']:.2e}, {args.confidence:.0%} CI {lower:.8f} - {upper:.8f})")
+        print(result['estimate'])
+        raise SystemExit
+
+    for result in stream_pi_estimate(int(args.samples), workers=args.workers, block_size=int(args.block_size),
+                                     chunk_size=args.chunk_size, seed=args.seed, confidence=args.confidence):
+        lower, upper = result['interval']
+        print(f"{result['samples']} samples: pi ~ {result['estimate']:.8f} "
+              f"({args.confidence:.0%} CI {lower:.8f} - {upper:.8f})")
+    print(result['estimate'])
+
+    # python pi_estimate.py --samples 1e10 --workers 8 --seed 42
+    # python pi_estimate.py --tolerance 1e-4 --mode sobol
+    # python pi_estimate.py --benchmark --tolerance 1e-3 --batch-size 4096
@@ -0,0 +1,153 @@
+# packages
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import struct
+from spatial_index import GridIndex
+
+# constants
+INDEX_MAGIC = b'KNNIDX01'  # file signature and format version
+INDEX_ALIGN = 64  # byte alignment of the header end and of each array
+
+
+# functions
+
+def csv_fingerprint(csv_file, with_hash=True):
+    '''
+    Function fingerprints the sale information so a stale index file can be detected
+    :param csv_file: path of the sale information (str)
+    :param with_hash: include the sha256 of the file contents (bool)
+    :return: dict of mtime_ns, size and sha256
+    '''
+    stat = os.stat(csv_file)
+    fingerprint = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': None}
+    if with_hash:
+        sha256 = hashlib.sha256()
+        with open(csv_file, 'rb') as file:
+            for block in iter(lambda: file.read(2 ** 20), b''):
+                sha256.update(block)
+        fingerprint['sha256'] = sha256.hexdigest()
+    return fingerprint
+
+
+def default_index_file(csv_file):
+    '''
+    Function returns the default path of the index file of the sale information (next to the csv)
+    '''
+    return csv_file + '.idx'
+
+
+def build_sales_index_file(csv_file, index_file=None, cell_size=None):
+    '''
+    Function writes the radians coordinates, ids and grid index of the sale information to a binary index file:
+    magic, header length (uint64), json header, then each array at an aligned offset recorded in the header
+    :param csv_file: path of the sale information with columns id, lat, long (str)
+    :param index_file: path of the index file (str), next to the csv if None
+    :param cell_size: width of a grid cell in radians (float), derived from the data if None
+    :return: GridIndex memory-mapped from the index file
+    '''
+    index_file = index_file or default_index_file(csv_file)
+    fingerprint = csv_fingerprint(csv_file)
+    sales_df = pd.read_csv(csv_file, sep=',', header=0, usecols=['id', 'lat', 'long'])
+    n_sold_df = pd.DataFrame({'id': sales_df['id'].to_numpy(dtype=np.int64),
+                              'latitude': np.radians(sales_df['lat'].to_numpy(dtype=np.float64)),
+                              'longitude': np.radians(sales_df['long'].to_numpy(dtype=np.float64))})
+    grid = GridIndex(n_sold_df, cell_size=cell_size)
+
+    arrays = {'ids': grid.ids, 'cords': grid.cords, 'cell_keys': grid.cell_keys, 'cell_starts': grid.cell_starts}
+    header = {'source': dict(fingerprint, path=os.path.abspath(csv_file)), 'n_sold': len(n_sold_df),
+              'origin': grid.origin.tolist(), 'cell_size': grid.cell_size, 'shape': grid.shape.tolist(), 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += -(-array.nbytes // INDEX_ALIGN) * INDEX_ALIGN
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(len(INDEX_MAGIC) + 8 + len(header_bytes)) % INDEX_ALIGN)
+
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'wb') as file:
+        file.write(INDEX_MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            file.write(data + b'\0' * (-len(data) % INDEX_ALIGN))
+    os.replace(tmp_file, index_file)  # readers never see a partially written index
+    return load_sales_index_file(index_file)
+
+
+def read_sales_index_header(index_file):
+    '''
+    Function reads the header of a sales index file
+    :param index_file: path of the index file (str)
+    :return: header (dict), byte offset of the first array (int)
+    '''
+    with open(index_file, 'rb') as file:
+        if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{index_file} is not a sales index file")
+        (header_length,) = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(header_length))
+    return header, len(INDEX_MAGIC) + 8 + header_length
+
+
+def load_sales_index_file(index_file):
+    '''
+    Function memory-maps a sales index file
+    :param index_file: path of the index file (str)
+    :return: GridIndex whose arrays are read-only views of the memory-mapped file
+    '''
+    header, data_offset = read_sales_index_header(index_file)
+    buffer = np.memmap(index_file, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        start = data_offset + spec['offset']
+        arrays[name] = buffer[start:start + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+    grid = GridIndex.from_arrays(origin=header['origin'], cell_size=header['cell_size'], shape=header['shape'], **arrays)
+    grid.header = header
+    return grid
+
+
+def sold_properties_frame(sales_index):
+    '''
+    Function returns the sold properties of a sales index as the n_sold_df used by return_k_nearest_sold_properties
+    :param sales_index: GridIndex memory-mapped from an index file
+    :return: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+    '''
+    return pd.DataFrame({'id': sales_index.ids,
+                         'latitude': sales_index.cords[:, 0],
+                         'longitude': sales_index.cords[:, 1]})
+
+
+def is_stale(index_file, csv_file, verify_hash=False):
+    '''
+    Function checks whether the index file is missing or out of date with the sale information
+    :param index_file: path of the index file (str)
+    :param csv_file: path of the sale information (str)
+    :param verify_hash: also compare the sha256 of the csv, catching edits that keep the mtime and size (bool)
+    :return: bool
+    '''
+    if not os.path.exists(index_file):
+        return True
+    try:
+        source = read_sales_index_header(index_file)[0]['source']
+    except (ValueError, KeyError, struct.error, json.JSONDecodeError):
+        return True  # unreadable or older format
+    fingerprint = csv_fingerprint(csv_file, with_hash=verify_hash)
+    if (source['mtime_ns'], source['size']) != (fingerprint['mtime_ns'], fingerprint['size']):
+        return True
+    return verify_hash and source['sha256'] != fingerprint['sha256']
+
+
+def open_sales_index(csv_file, index_file=None, verify_hash=False):
+    '''
+    Function memory-maps the index file of the sale information, rebuilding it first if it is missing or stale
+    :param csv_file: path of the sale information (str)
+    :param index_file: path of the index file (str), next to the csv if None
+    :param verify_hash: also compare the sha256 of the csv (bool)
+    :return: GridIndex memory-mapped from the index file
+    '''
+    index_file = index_file or default_index_file(csv_file)
+    if is_stale(index_file, csv_file, verify_hash):
+        return build_sales_index_file(csv_file, index_file)
+    return load_sales_index_file(index_file)
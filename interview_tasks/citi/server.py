@@ -0,0 +1,233 @@
+# packages
+import numpy as np
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from main import return_k_nearest_sold_properties, return_k_nearest_sold_properties_index, scipy_euclidean_distance
+from sales_index import open_sales_index, sold_properties_frame
+from spatial_index import INDEX_BACKENDS, build_index, check_k_nearest
+
+
+# classes
+
+class KnnRequest:
+    '''
+    Pending lookup of the k nearest sold properties for a set of observed properties
+    '''
+
+    def __init__(self, m_obs_array, k_nearest):
+        self.m_obs_array = m_obs_array
+        self.k_nearest = k_nearest
+        self.start = time.perf_counter()
+        self.done = threading.Event()
+        self.ids = None
+        self.error = None
+
+
+class KnnService:
+    '''
+    Warm k nearest sold properties service: the sold properties (and their spatial index) stay in memory and
+    concurrent requests are micro-batched into a single vectorized lookup
+    '''
+
+    def __init__(self, n_sold_df, sold_index=None, batch_window_ms=2.0, max_batch=1024, latency_window=10000):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        :param sold_index: spatial index of the sold properties, brute force scipy_euclidean_distance if None
+        :param batch_window_ms: time to wait for more requests after the first request of a batch (ms)
+        :param max_batch: maximum number of observed properties in a batch (int)
+        :param latency_window: number of most recent request latencies kept for the percentiles (int)
+        '''
+        self.n_sold_df = n_sold_df
+        self.sold_index = sold_index
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=latency_window)
+        self.counters = {'requests': 0, 'batches': 0, 'observed_properties': 0, 'errors': 0}
+        self.lock = threading.Lock()
+        self.batcher = threading.Thread(target=self._run, daemon=True)
+        self.batcher.start()
+
+    def query(self, m_obs_array, k_nearest, timeout=None):
+        '''
+        Function returns the IDs of the k nearest sold properties, blocking until the batch holding the request is done
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) in radians (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :param timeout: maximum time to wait (seconds)
+        :return: array containing id of the k nearest sold properties for each observed property m (m x k array)
+        '''
+        request = KnnRequest(np.atleast_2d(np.asarray(m_obs_array, dtype=np.float64)), k_nearest)
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError('k nearest sold properties request timed out')
+        if request.error is not None:
+            raise request.error
+        return request.ids
+
+    def metrics(self):
+        '''
+        Function returns the request counters and the latency percentiles of the most recent requests (ms)
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            metrics = dict(self.counters)
+        metrics['mean_batch_size'] = metrics['observed_properties'] / metrics['batches'] if metrics['batches'] else 0.0
+        for percentile in (50, 90, 99):
+            metrics[f'p{percentile}_ms'] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return metrics
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0].m_obs_array)
+            deadline = time.perf_counter() + self.batch_window
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.m_obs_array)
+            for k_nearest in {request.k_nearest for request in batch}:  # one vectorized lookup per k
+                self._process([request for request in batch if request.k_nearest == k_nearest], k_nearest)
+
+    def _process(self, batch, k_nearest):
+        try:
+            m_obs_array = np.concatenate([request.m_obs_array for request in batch])
+            if self.sold_index is None:
+                ids = return_k_nearest_sold_properties(k_nearest, m_obs_array, self.n_sold_df, scipy_euclidean_distance,
+                                                       verbose=False)  # latencies are reported through /metrics
+            else:
+                ids = return_k_nearest_sold_properties_index(k_nearest, m_obs_array, self.sold_index)
+            splits = np.cumsum([len(request.m_obs_array) for request in batch])[:-1]
+            for request, request_ids in zip(batch, np.split(ids, splits)):
+                request.ids = request_ids
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        end = time.perf_counter()
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['requests'] += len(batch)
+            self.counters['observed_properties'] += sum(len(request.m_obs_array) for request in batch)
+            self.counters['errors'] += len(batch) if batch[0].error is not None else 0
+            self.latencies.extend(end - request.start for request in batch)
+        for request in batch:
+            request.done.set()
+
+
+class KnnRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP interface of the service:
+    GET /knn?lat=47.5112,47.7210&long=-122.257,-122.319&k=10 or POST /knn {"lat": [...], "long": [...], "k": 10}
+    (decimal degrees), GET /metrics and GET /health
+    '''
+
+    def __init__(self, *args, service, **kwargs):
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif url.path == '/metrics':
+            self._send(200, self.service.metrics())
+        elif url.path == '/knn':
+            params = parse_qs(url.query)
+            self._knn(lat=params.get('lat', [''])[0].split(','), long=params.get('long', [''])[0].split(','),
+                      k=params.get('k', [10])[0])
+        else:
+            self._send(404, {'error': f'unknown path {url.path}'})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/knn':
+            self._send(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as e:
+            self._send(400, {'error': f'invalid json: {e}'})
+            return
+        if not isinstance(body, dict):
+            self._send(400, {'error': 'the json body must be an object with lat, long and k'})
+            return
+        self._knn(lat=body.get('lat', []), long=body.get('long', []), k=body.get('k', 10))
+
+    def _knn(self, lat, long, k):
+        try:
+            lat, long, k = np.asarray(lat, dtype=float), np.asarray(long, dtype=float), int(k)
+            if lat.ndim != 1 or lat.shape != long.shape or not len(lat):
+                raise ValueError('lat and long must be non-empty lists of the same length')
+            check_k_nearest(k, len(self.service.n_sold_df))
+        except (TypeError, ValueError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        try:
+            ids = self.service.query(np.radians(np.column_stack([lat, long])), k)
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, {'ids': ids.tolist()})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # request latencies are reported through /metrics
+
+
+# functions
+
+def make_server(service, host='127.0.0.1', port=8080):
+    '''
+    Function creates the HTTP server of the service (port 0 picks a free port)
+    :param service: KnnService
+    :param host: host to bind (str)
+    :param port: port to bind (int)
+    :return: ThreadingHTTPServer
+    '''
+    return ThreadingHTTPServer((host, port), partial(KnnRequestHandler, service=service))
+
+
+# main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=os.getcwd(), type=str, help='filepath for sale information')
+    parser.add_argument('--file', default='sales.csv', type=str, help='filename for sale information')
+    parser.add_argument('--index-file', type=str, help='sales index file (default <file>.idx next to the sale information)')
+    parser.add_argument('--index', default='kdtree', choices=list(INDEX_BACKENDS) + ['none'],
+                        help='spatial index backend kept warm in memory (none: brute force scipy distance)')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='host to bind')
+    parser.add_argument('--port', default=8080, type=int, help='port to bind')
+    parser.add_argument('--batch-window', default=2.0, type=float, help='micro-batching window (ms)')
+    parser.add_argument('--max-batch', default=1024, type=int, help='maximum observed properties per batch')
+    args = parser.parse_args()
+
+    sales_index = open_sales_index(os.path.join(args.path, args.file), args.index_file)
+    n_sold_df = sold_properties_frame(sales_index)
+    service = KnnService(n_sold_df, sold_index=None if args.index == 'none' else
+                         sales_index if args.index == 'grid' else build_index(n_sold_df, backend=args.index),
+                         batch_window_ms=args.batch_window, max_batch=args.max_batch)
+    server = make_server(service, host=args.host, port=args.port)
+    print(f"Serving k nearest sold properties on http://{args.host}:{server.server_address[1]} (/knn, /metrics)")
+    server.serve_forever()
+
+    # python server.py --path housing_data/ --file sales.csv --port 8080
+    # curl "http://127.0.0.1:8080/knn?lat=47.5112,47.7210&long=-122.257,-122.319&k=10"
@@ -0,0 +1,270 @@
+# packages
+import numpy as np
+import scipy.spatial
+from sklearn.neighbors import BallTree
+from geodesic import EARTH_RADIUS_KM, vincenty_pairwise
+
+
+# classes
+
+class KDTreeIndex:
+    '''
+    Spatial index of the sold properties backed by a KD-tree (scipy.spatial module)
+    '''
+
+    def __init__(self, n_sold_df):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        '''
+        self.ids = n_sold_df.id.to_numpy()  # property ids
+        self.cords = n_sold_df[['latitude', 'longitude']].to_numpy()  # sold properties array (n x 2 array)
+        self.tree = scipy.spatial.cKDTree(self.cords)
+
+    def query(self, m_obs_array, k_nearest):
+        '''
+        Function returns the k nearest sold properties for a set of observed properties m
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :return: distance (m x k array), positions of the sold properties in self.ids (m x k array)
+        '''
+        check_k_nearest(k_nearest, len(self.ids))
+        distance, idx = self.tree.query(m_obs_array, k=k_nearest)
+        return distance.reshape(-1, k_nearest), idx.reshape(-1, k_nearest)
+
+
+class BallTreeIndex:
+    '''
+    Spatial index of the sold properties backed by a ball tree (sklearn.neighbors module)
+    '''
+
+    def __init__(self, n_sold_df, metric='euclidean', leaf_size=40):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        :param metric: distance metric supported by sklearn.neighbors.BallTree (str)
+        :param leaf_size: number of points at which the tree switches to brute force (int)
+        '''
+        self.ids = n_sold_df.id.to_numpy()
+        self.cords = n_sold_df[['latitude', 'longitude']].to_numpy()
+        self.tree = BallTree(self.cords, leaf_size=leaf_size, metric=metric)
+
+    def query(self, m_obs_array, k_nearest):
+        '''
+        Function returns the k nearest sold properties for a set of observed properties m
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :return: distance (m x k array), positions of the sold properties in self.ids (m x k array)
+        '''
+        check_k_nearest(k_nearest, len(self.ids))
+        return self.tree.query(np.atleast_2d(m_obs_array), k=k_nearest)
+
+
+class HaversineIndex(BallTreeIndex):
+    '''
+    Spatial index of the sold properties answering great-circle (haversine) nearest neighbour queries with a ball tree,
+    optionally refined on the WGS-84 ellipsoid with Vincenty's formula
+    '''
+
+    def __init__(self, n_sold_df, refine=None, candidates=3, leaf_size=40):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) in radians (n x 3 dataframe)
+        :param refine: refinement stage applied to the haversine candidates (None, vincenty)
+        :param candidates: number of haversine candidates per nearest property re-ranked by the refinement stage (int)
+        :param leaf_size: number of points at which the tree switches to brute force (int)
+        '''
+        if refine not in (None, 'vincenty'):
+            raise ValueError(f"Unknown refinement stage '{refine}', expected None or 'vincenty'")
+        super().__init__(n_sold_df, metric='haversine', leaf_size=leaf_size)
+        self.refine = refine
+        self.candidates = candidates
+
+    def query(self, m_obs_array, k_nearest):
+        '''
+        Function returns the k nearest sold properties for a set of observed properties m
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) in radians (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :return: distance in km (m x k array), positions of the sold properties in self.ids (m x k array)
+        '''
+        m_obs_array = np.atleast_2d(m_obs_array)
+        if self.refine is None:
+            distance, idx = super().query(m_obs_array, k_nearest)
+            return distance * EARTH_RADIUS_KM, idx
+
+        # haversine candidates re-ranked by the ellipsoidal distance
+        check_k_nearest(k_nearest, len(self.ids))
+        _, idx = self.tree.query(m_obs_array, k=min(k_nearest * self.candidates, len(self.ids)))
+        distance = vincenty_pairwise(m_obs_array[:, None, 0], m_obs_array[:, None, 1],
+                                     self.cords[idx, 0], self.cords[idx, 1])
+        order = np.argsort(distance, axis=1)[:, :k_nearest]
+        return np.take_along_axis(distance, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+class GridIndex:
+    '''
+    Spatial index of the sold properties bucketed into a regular (latitude, longitude) grid (geohash style).
+    Properties are sorted by cell so each cell is a contiguous slice of self.cords / self.ids, and a query
+    searches rings of cells around the observed property until no unvisited cell can hold a nearer property.
+    With probes set the query is approximate: only the probes cells nearest to the observed property are searched
+    '''
+
+    def __init__(self, n_sold_df, cell_size=None, points_per_cell=8, probes=None):
+        '''
+        :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+        :param cell_size: width of a grid cell in coordinate units (float), derived from points_per_cell if None
+        :param points_per_cell: target average number of sold properties per cell (int)
+        :param probes: number of cells searched per observed property (int), exact search if None
+        '''
+        self.probes = probes
+        ids = n_sold_df.id.to_numpy()
+        cords = n_sold_df[['latitude', 'longitude']].to_numpy()
+        self.origin = cords.min(axis=0)
+        if cell_size is None:
+            extent = np.maximum(cords.max(axis=0) - self.origin, np.finfo(float).eps)
+            cell_size = np.sqrt(np.prod(extent) * points_per_cell / len(cords))
+        self.cell_size = float(cell_size)
+
+        cells = np.floor((cords - self.origin) / self.cell_size).astype(np.int64)
+        self.shape = cells.max(axis=0) + 1  # number of cells along (latitude, longitude)
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        order = np.argsort(keys, kind='stable')  # sort properties by cell
+        self.ids = ids[order]
+        self.cords = cords[order]
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_starts = np.append(self.cell_starts, len(keys))  # cell j spans cell_starts[j]:cell_starts[j + 1]
+
+    @classmethod
+    def from_arrays(cls, ids, cords, cell_keys, cell_starts, origin, cell_size, shape):
+        '''
+        Function restores a grid index from its arrays (e.g. memory-mapped from a sales index file) without re-sorting
+        :param ids: property ids sorted by cell (n array)
+        :param cords: (latitude, longitude) sorted by cell (n x 2 array)
+        :param cell_keys: keys of the non-empty cells (c array)
+        :param cell_starts: start position of each non-empty cell, followed by n (c + 1 array)
+        :param origin: (latitude, longitude) of the grid origin
+        :param cell_size: width of a grid cell in coordinate units (float)
+        :param shape: number of cells along (latitude, longitude)
+        :return: GridIndex
+        '''
+        grid = cls.__new__(cls)
+        grid.probes = None
+        grid.ids, grid.cords, grid.cell_keys, grid.cell_starts = ids, cords, cell_keys, cell_starts
+        grid.origin, grid.cell_size, grid.shape = np.asarray(origin), float(cell_size), np.asarray(shape, dtype=np.int64)
+        return grid
+
+    def query(self, m_obs_array, k_nearest, probes=None):
+        '''
+        Function returns the k nearest sold properties for a set of observed properties m
+        :param m_obs_array: array of (m observed properties) x (latitude, longitude) (m x 2 array)
+        :param k_nearest: number of nearest properties to return (int)
+        :param probes: number of cells searched per observed property (int), self.probes if None
+        :return: distance (m x k array), positions of the sold properties in self.ids (m x k array)
+        '''
+        check_k_nearest(k_nearest, len(self.ids))
+        probes = probes or self.probes
+        m_obs_array = np.atleast_2d(m_obs_array)
+        distance = np.full((len(m_obs_array), k_nearest), np.inf)
+        idx = np.full((len(m_obs_array), k_nearest), -1, dtype=np.int64)
+        for i, cord in enumerate(m_obs_array):
+            d, pos = self._query_probes(cord, k_nearest, probes) if probes else (None, None)
+            if d is None:  # exact search, or fewer than k properties in the probed cells
+                d, pos = self._query_one(cord, k_nearest)
+            distance[i], idx[i] = d, pos
+        return distance, idx
+
+    def _query_probes(self, cord, k_nearest, probes):
+        '''
+        Function searches the probes cells nearest to the observed property (approximate k nearest)
+        '''
+        radius = int(np.ceil((np.sqrt(probes) - 1) / 2)) + 1
+        offsets = np.arange(-radius, radius + 1)
+        cells = np.floor((cord - self.origin) / self.cell_size).astype(np.int64) + \
+            np.stack(np.meshgrid(offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 2)
+        cells = cells[np.all((cells >= 0) & (cells < self.shape), axis=1)]
+        # distance from the observed property to the nearest point of each cell
+        low = self.origin + cells * self.cell_size
+        gap = np.maximum(np.maximum(low - cord, cord - low - self.cell_size), 0)
+        cell_distance = np.sum(gap ** 2, axis=1)
+        if len(cells) > probes:
+            cells = cells[np.argpartition(cell_distance, probes - 1)[:probes]]
+        pos = self._cell_positions(cells)
+        if len(pos) < k_nearest:
+            return None, None
+        distance = np.sqrt(np.sum((self.cords[pos] - cord) ** 2, axis=1))
+        top = np.argpartition(distance, k_nearest - 1)[:k_nearest] if len(pos) > k_nearest else np.arange(len(pos))
+        top = top[np.argsort(distance[top])]
+        return distance[top], pos[top]
+
+    def _query_one(self, cord, k_nearest):
+        cell = np.floor((cord - self.origin) / self.cell_size).astype(np.int64)
+        last_ring = np.max(np.abs(np.concatenate([cell, cell - self.shape + 1])))  # ring covering the whole grid
+        best_distance, best_pos = np.empty(0), np.empty(0, dtype=np.int64)
+        ring = 0
+        while True:
+            pos = self._ring_positions(cell, ring)
+            if pos.size:
+                best_distance = np.concatenate([best_distance, np.sqrt(np.sum((self.cords[pos] - cord) ** 2, axis=1))])
+                best_pos = np.concatenate([best_pos, pos])
+                if len(best_pos) > k_nearest:
+                    keep = np.argpartition(best_distance, k_nearest - 1)[:k_nearest]
+                    best_distance, best_pos = best_distance[keep], best_pos[keep]
+            # cells outside the searched rings are at least ring x cell_size away from the observed property
+            if len(best_pos) == k_nearest and best_distance.max() <= ring * self.cell_size:
+                break
+            if ring >= last_ring:
+                break
+            ring += 1
+        order = np.argsort(best_distance)
+        return best_distance[order], best_pos[order]
+
+    def _ring_positions(self, cell, ring):
+        '''
+        Function returns the positions of the sold properties in the ring of cells at Chebyshev distance ring from cell
+        '''
+        offsets = np.arange(-ring, ring + 1)
+        if ring == 0:
+            ring_cells = cell[None, :]
+        else:
+            edge = np.full(len(offsets), ring)
+            ring_cells = cell + np.unique(np.concatenate([
+                np.column_stack([-edge, offsets]), np.column_stack([edge, offsets]),
+                np.column_stack([offsets, -edge]), np.column_stack([offsets, edge])]), axis=0)
+        return self._cell_positions(ring_cells[np.all((ring_cells >= 0) & (ring_cells < self.shape), axis=1)])
+
+    def _cell_positions(self, cells):
+        '''
+        Function returns the positions of the sold properties in the given cells (c x 2 array)
+        '''
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        j = np.searchsorted(self.cell_keys, keys)
+        j = j[(j < len(self.cell_keys)) & (self.cell_keys[np.minimum(j, len(self.cell_keys) - 1)] == keys)]
+        if not j.size:
+            return np.empty(0, dtype=np.int64)
+        start, lengths = self.cell_starts[j], self.cell_starts[j + 1] - self.cell_starts[j]
+        return np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())  # concatenated ranges
+
+
+# functions
+
+INDEX_BACKENDS = {'kdtree': KDTreeIndex, 'balltree': BallTreeIndex, 'grid': GridIndex, 'haversine': HaversineIndex}
+
+
+def check_k_nearest(k_nearest, n_sold):
+    '''
+    Function checks the number of nearest properties requested can be returned
+    :param k_nearest: number of nearest properties to return (int)
+    :param n_sold: number of sold properties in the index (int)
+    '''
+    if not 0 < k_nearest <= n_sold:
+        raise ValueError(f"k_nearest must be between 1 and the number of sold properties ({n_sold}), got {k_nearest}")
+
+
+def build_index(n_sold_df, backend='kdtree', **kwargs):
+    '''
+    Function builds a spatial index of the sold properties
+    :param n_sold_df: dataframe of (n sold properties) by (id, latitude, longitude) (n x 3 dataframe)
+    :param backend: index backend (kdtree, balltree, grid, haversine)
+    :param kwargs: keyword arguments passed to the index backend
+    :return: spatial index exposing ids and query(m_obs_array, k_nearest)
+    '''
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown index backend '{backend}', expected one of {list(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](n_sold_df, **kwargs)
@@ -0,0 +1,230 @@
+import io
+import time
+import pandas as pd
+from sqlalchemy import text
+from features import features_from_aggregates
+
+FEATURES_TABLE = 'user_transaction_features'
+AGGREGATE_COLUMNS = ['transaction_count', 'amount_sum', 'income_count', 'expense_count']
+AGGREGATE_DTYPES = {'user_id': 'int64', 'transaction_count': 'int64', 'amount_sum': 'float64',
+                    'income_count': 'int64', 'expense_count': 'int64'}
+
+# partial aggregates of each user, month and transaction type of the transactions selected by {where}
+MONTH_AGGREGATES_SQL = """
+SELECT A.USER_ID, DATE_TRUNC('month', T.TRANSACTION_DATE)::DATE AS MONTH, T.TRANSACTION_TYPE,
+       COUNT(*) AS TRANSACTION_COUNT, SUM(T.TRANSACTION_AMOUNT) AS AMOUNT_SUM,
+       COUNT(*) FILTER (WHERE T.TRANSACTION_AMOUNT > 0) AS INCOME_COUNT,
+       COUNT(*) FILTER (WHERE T.TRANSACTION_AMOUNT < 0) AS EXPENSE_COUNT
+FROM TRANSACTIONS T JOIN ACCOUNTS A ON A.ACCOUNT_ID = T.ACCOUNT_ID
+WHERE {where}
+GROUP BY 1, 2, 3
+"""
+
+
+def quote(name):
+    '''
+    Function quotes a column name (the feature names contain the transaction types, e.g. "car maintenance")
+    '''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def latest_version(connection):
+    '''
+    Function returns the latest row of feature_versions, None if the store was never built
+    '''
+    return connection.execute(text("""SELECT feature_version, window_start, window_end, last_transaction_id
+                                      FROM feature_versions ORDER BY feature_version DESC LIMIT 1""")).mappings().first()
+
+
+def aggregates_in_sync(connection, last_transaction_id):
+    '''
+    Function checks that the stored partial aggregates count every transaction up to last_transaction_id, which is no
+    longer the case after a full reload of the transactions. The transactions are counted through the accounts, as
+    in the aggregates, so transactions without an account do not force a rebuild
+    '''
+    stored = connection.execute(text("SELECT COALESCE(SUM(transaction_count), 0) FROM user_month_aggregates")).scalar()
+    current = connection.execute(text("""SELECT COUNT(*)
+                                         FROM TRANSACTIONS T JOIN ACCOUNTS A ON A.ACCOUNT_ID = T.ACCOUNT_ID
+                                         WHERE T.TRANSACTION_ID <= :last"""),
+                                 {'last': last_transaction_id}).scalar()
+    return int(stored) == int(current)
+
+
+def update_aggregates(connection, version, last_transaction_id=None):
+    '''
+    Function recomputes the partial aggregates of the (user, month) pairs with transactions above
+    last_transaction_id, or every aggregate if None
+    :return: ids of the users whose aggregates changed (list of int), None if every aggregate was rebuilt
+    '''
+    columns = 'user_id, month, transaction_type, transaction_count, amount_sum, income_count, expense_count'
+    if last_transaction_id is None:
+        connection.execute(text("TRUNCATE user_month_aggregates"))
+        connection.execute(text(f"INSERT INTO user_month_aggregates ({columns}, feature_version) "
+                                f"SELECT *, :version FROM ({MONTH_AGGREGATES_SQL.format(where='TRUE')}) M"),
+                           {'version': version})
+        return None
+
+    connection.execute(text("""CREATE TEMPORARY TABLE affected_months ON COMMIT DROP AS
+                               SELECT DISTINCT A.USER_ID, DATE_TRUNC('month', T.TRANSACTION_DATE)::DATE AS MONTH
+                               FROM TRANSACTIONS T JOIN ACCOUNTS A ON A.ACCOUNT_ID = T.ACCOUNT_ID
+                               WHERE T.TRANSACTION_ID > :last"""), {'last': last_transaction_id})
+    # the months are recomputed whole, so a rerun gives the same aggregates
+    where = "(A.USER_ID, DATE_TRUNC('month', T.TRANSACTION_DATE)::DATE) IN (SELECT user_id, month FROM affected_months)"
+    connection.execute(text(f"""INSERT INTO user_month_aggregates ({columns}, feature_version)
+                                SELECT *, :version FROM ({MONTH_AGGREGATES_SQL.format(where=where)}) M
+                                ON CONFLICT (user_id, month, transaction_type) DO UPDATE SET
+                                    transaction_count = EXCLUDED.transaction_count,
+                                    amount_sum = EXCLUDED.amount_sum,
+                                    income_count = EXCLUDED.income_count,
+                                    expense_count = EXCLUDED.expense_count,
+                                    feature_version = EXCLUDED.feature_version"""), {'version': version})
+    return [row[0] for row in connection.execute(text("SELECT DISTINCT user_id FROM affected_months"))]
+
+
+def feature_window(connection, months=6):
+    '''
+    Function returns the window of the features as in task2: the last months before the most recent transaction of
+    the users with an active consent
+    :return: window start, window end (pd.Timestamp), None if there are no transactions
+    '''
+    window_end = connection.execute(text("""SELECT MAX(T.TRANSACTION_DATE)
+                                            FROM TRANSACTIONS T
+                                            JOIN ACCOUNTS A ON A.ACCOUNT_ID = T.ACCOUNT_ID
+                                            JOIN USER_CONSENTS UC ON UC.USER_ID = A.USER_ID
+                                            WHERE UC.CONSENT_STATUS = 'active'""")).scalar()
+    if window_end is None:
+        return None, None
+    window_end = pd.Timestamp(window_end)
+    return window_end - pd.DateOffset(months=months), window_end
+
+
+def window_aggregates(connection, window_start, users=None):
+    '''
+    Function returns the aggregates of the window of the users with an active consent: the stored monthly aggregates
+    of the whole months after the first month of the window, and the aggregates of the days of the first month in
+    the window computed from the transactions
+    :param users: only these users (list of int), every user if None
+    :return: dataframe of (user_id, transaction_type, transaction_count, amount_sum, income_count, expense_count)
+    '''
+    first_month = window_start.to_period('M').to_timestamp()
+    active = "USER_ID IN (SELECT USER_ID FROM USER_CONSENTS WHERE CONSENT_STATUS = 'active')"
+    selected = "" if users is None else " AND USER_ID = ANY(:users)"
+    params = {'first_month': first_month.date(), 'window_start': window_start.date(), 'users': users}
+    stored = pd.read_sql(text(f"""SELECT user_id, transaction_type, {', '.join(AGGREGATE_COLUMNS)}
+                                  FROM user_month_aggregates
+                                  WHERE month > :first_month AND {active}{selected}"""), connection, params=params)
+    where = f"""T.TRANSACTION_DATE >= :window_start
+                AND T.TRANSACTION_DATE < CAST(:first_month AS DATE) + INTERVAL '1 month'
+                AND A.{active}{selected.replace('USER_ID', 'A.USER_ID')}"""
+    first = pd.read_sql(text(f"SELECT user_id, transaction_type, {', '.join(AGGREGATE_COLUMNS)} "
+                             f"FROM ({MONTH_AGGREGATES_SQL.format(where=where)}) M"), connection, params=params)
+    # an empty frame read from the database has object columns, the concat would make every aggregate object too
+    frames = [frame for frame in (stored, first) if len(frame)]
+    aggregates = pd.concat(frames, ignore_index=True) if frames else stored
+    return aggregates.astype(AGGREGATE_DTYPES)
+
+
+def upsert_features(connection, features, version, replace=False):
+    '''
+    Function bulk upserts feature rows: COPY into a staging table, then INSERT ... ON CONFLICT (user_id); feature
+    columns of transaction types new to the table are added first
+    :param features: dataframe of one row per user_id (user_id as str, as in task2)
+    :param replace: recreate the table (bool)
+    '''
+    features = features.assign(feature_version=version)
+    if replace:
+        connection.execute(text(f"DROP TABLE IF EXISTS {FEATURES_TABLE}"))
+        # explicit DDL: the column types must not depend on the dtypes to_sql infers from the frame
+        columns = ', '.join(f"{quote(column)} DOUBLE PRECISION" for column in features.columns
+                            if column not in ('user_id', 'feature_version'))
+        connection.execute(text(f"""CREATE TABLE {FEATURES_TABLE} (user_id TEXT PRIMARY KEY,
+                                    {columns + ', ' if columns else ''}feature_version INT NOT NULL)"""))
+    else:
+        existing = list(pd.read_sql(text(f"SELECT * FROM {FEATURES_TABLE} LIMIT 0"), connection).columns)
+        new = [column for column in features.columns if column not in existing]
+        for column in new:
+            connection.execute(text(f"ALTER TABLE {FEATURES_TABLE} ADD COLUMN {quote(column)} DOUBLE PRECISION"))
+        # every column is written, features of transaction types the users no longer have become NULL
+        features = features.reindex(columns=existing + new)
+
+    columns = ', '.join(quote(column) for column in features.columns)
+    connection.execute(text(f"CREATE TEMPORARY TABLE stage_features (LIKE {FEATURES_TABLE}) ON COMMIT DROP"))
+    buffer = io.StringIO()
+    features.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    with connection.connection.cursor() as cursor:  # same transaction as the SQLAlchemy connection
+        cursor.copy_expert(f"COPY stage_features ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    updates = ', '.join(f"{quote(column)} = EXCLUDED.{quote(column)}" for column in features.columns
+                        if column != 'user_id')
+    connection.execute(text(f"""INSERT INTO {FEATURES_TABLE} ({columns}) SELECT {columns} FROM stage_features
+                                ON CONFLICT (user_id) DO UPDATE SET {updates}"""))
+
+
+def refresh_features(engine, months=6, full=False):
+    '''
+    Function brings user_transaction_features up to date in one transaction. The store keeps partial aggregates per
+    user, month and transaction type (user_month_aggregates): only the (user, month) pairs with new transactions are
+    recomputed from the transactions, and only the affected users are rolled up into the window of features and
+    upserted. Every user is rolled up again (from the aggregates) when the window moves, and everything is rebuilt
+    on the first run, when full or after a full reload of the transactions. Each refresh is recorded as a new
+    version in feature_versions and stamped on the feature rows it wrote
+    :param engine: SQLAlchemy engine
+    :param months: number of months of the window (int)
+    :param full: rebuild every aggregate and feature (bool)
+    :return: dict (feature_version, full_rebuild, users_updated, users_removed, seconds)
+    '''
+    start = time.perf_counter()
+    with engine.begin() as connection:  # commits on success, rolls back on any error
+        connection.execute(text("SET LOCAL statement_timeout = 0"))  # a batch job, not bound by the app's query timeout
+        connection.execute(text("LOCK TABLE feature_versions IN EXCLUSIVE MODE"))  # one refresh at a time
+        previous = latest_version(connection)
+        version = (previous['feature_version'] if previous else 0) + 1
+        last_transaction_id = connection.execute(text("SELECT MAX(transaction_id) FROM transactions")).scalar()
+        has_table = connection.execute(text("SELECT to_regclass(:table)"), {'table': FEATURES_TABLE}).scalar()
+        full = (full or previous is None or previous['last_transaction_id'] is None or has_table is None
+                or not aggregates_in_sync(connection, previous['last_transaction_id']))
+
+        affected_users = update_aggregates(connection, version,
+                                           None if full else previous['last_transaction_id'])
+        window_start, window_end = feature_window(connection, months)
+        moved = previous is None or (previous['window_start'], previous['window_end']) != (
+            window_start and window_start.date(), window_end and window_end.date())
+
+        removed = 0
+        if window_start is None:
+            features = pd.DataFrame(columns=['user_id'])
+        elif full or moved:
+            features = features_from_aggregates(window_aggregates(connection, window_start), months)
+        else:
+            # users with new transactions, and users whose consent became active
+            active_users = [row[0] for row in connection.execute(text(
+                "SELECT user_id FROM user_consents WHERE consent_status = 'active' "
+                f"AND user_id::text NOT IN (SELECT user_id FROM {FEATURES_TABLE})"))]
+            users = sorted(set(affected_users) | set(active_users))
+            if users:
+                features = features_from_aggregates(window_aggregates(connection, window_start, users), months)
+            else:  # nothing new since the last refresh
+                features = pd.DataFrame(columns=['user_id'])
+        if len(features):
+            features['user_id'] = features['user_id'].astype(str)
+
+        if full or moved or window_start is None:
+            upsert_features(connection, features, version, replace=full or window_start is None)
+            # users without transactions in the window any more
+            removed = connection.execute(text(f"DELETE FROM {FEATURES_TABLE} WHERE feature_version <> :version"),
+                                         {'version': version}).rowcount
+        else:
+            if len(features):
+                upsert_features(connection, features, version)
+            removed = connection.execute(text(
+                f"""DELETE FROM {FEATURES_TABLE} WHERE user_id NOT IN
+                    (SELECT user_id::text FROM user_consents WHERE consent_status = 'active')""")).rowcount
+
+        connection.execute(text("""INSERT INTO feature_versions (feature_version, window_start, window_end,
+                                       last_transaction_id, users_updated, full_rebuild, created_at)
+                                   VALUES (:version, :window_start, :window_end, :last, :users, :full, now())"""),
+                           {'version': version, 'window_start': window_start and window_start.date(),
+                            'window_end': window_end and window_end.date(), 'last': last_transaction_id,
+                            'users': len(features), 'full': bool(full)})
+    return {'feature_version': version, 'full_rebuild': bool(full), 'users_updated': len(features),
+            'users_removed': removed, 'seconds': time.perf_counter() - start}
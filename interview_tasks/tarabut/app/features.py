@@ -0,0 +1,232 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+# transaction types of the sample data, used for the synthetic benchmark data
+TRANSACTION_TYPES = ['deposit', 'dining', 'entertainment', 'groceries', 'income', 'loan', 'medical', 'rent',
+                     'utilities', 'withdrawal']
+# per user totals, the columns every feature frame has (the per type columns depend on the types present)
+TOTAL_DTYPES = {'total_transactions': 'int64', 'total_income_transactions': 'int64',
+                'total_expense_transactions': 'int64', 'total_transaction_amount': 'float64',
+                'avg_transaction_amount': 'float64'}
+
+
+def build_features(user_transactions, months=6):
+    '''
+    Function builds the user_transaction_features table of task2 with vectorized named aggregations only
+    (no per-group Python functions):
+    - number, total and average of the transactions, number of income (> 0) and expense (< 0) transactions
+    - average amount and number of transactions of each transaction type
+    - consecutive_<type>_pct: the transactions of each type per month of the window. The consecutive runs of a type
+      partition its transactions, so the summed run lengths are the number of transactions of the type
+    :param user_transactions: transactions joined with the accounts and user consents (dataframe with user_id,
+                              transaction_type, transaction_amount)
+    :param months: number of months of the window (int)
+    :return: dataframe of one row per user_id
+    '''
+    amount = user_transactions['transaction_amount']
+    frame = pd.DataFrame({'user_id': user_transactions['user_id'],
+                          'transaction_type': user_transactions['transaction_type'],
+                          'transaction_amount': amount,
+                          'income': amount.gt(0).astype(np.int64),
+                          'expense': amount.lt(0).astype(np.int64)})
+
+    aggregated_data = frame.groupby('user_id').agg(
+        total_transactions=('transaction_amount', 'count'),
+        total_income_transactions=('income', 'sum'),
+        total_expense_transactions=('expense', 'sum'),
+        total_transaction_amount=('transaction_amount', 'sum'),
+        avg_transaction_amount=('transaction_amount', 'mean'),
+    ).reset_index()
+
+    by_type = frame.groupby(['user_id', 'transaction_type']).agg(
+        avg_transaction_amount=('transaction_amount', 'mean'),
+        transaction_count=('transaction_amount', 'count')
+    )
+    return _assemble_features(aggregated_data, by_type, months)
+
+
+def _assemble_features(aggregated_data, by_type, months):
+    '''
+    Function joins the per user totals with the per type averages, counts and consecutive_<type>_pct columns. Without
+    any user it returns an empty frame of the user_id and total columns
+    '''
+    if by_type.empty:
+        return aggregated_data[['user_id'] + list(TOTAL_DTYPES)].astype(TOTAL_DTYPES)
+    by_type = by_type[['avg_transaction_amount', 'transaction_count']].unstack('transaction_type')
+    avg_transaction_pivot = by_type.copy()
+    avg_transaction_pivot.columns = [f'{stat}_{trans_type}' for stat, trans_type in by_type.columns]
+
+    consecutive_pivot = by_type['transaction_count'] / months
+    consecutive_pivot.columns = [f'consecutive_{trans_type}_pct' for trans_type in consecutive_pivot.columns]
+
+    user_transaction_features = aggregated_data.merge(avg_transaction_pivot.reset_index(), on='user_id', how='left')
+    return user_transaction_features.merge(consecutive_pivot.reset_index(), on='user_id', how='left')
+
+
+def month_aggregates(user_transactions):
+    '''
+    Function computes the partial aggregates of each user, month and transaction type, from which the features of
+    any window of whole months are rolled up (see features_from_aggregates)
+    :param user_transactions: transactions with user_id, transaction_date, transaction_type, transaction_amount
+    :return: dataframe of (user_id, month, transaction_type, transaction_count, amount_sum, income_count,
+             expense_count)
+    '''
+    amount = user_transactions['transaction_amount']
+    frame = pd.DataFrame({'user_id': user_transactions['user_id'],
+                          'month': user_transactions['transaction_date'].dt.to_period('M').dt.to_timestamp(),
+                          'transaction_type': user_transactions['transaction_type'],
+                          'transaction_amount': amount,
+                          'income': amount.gt(0).astype(np.int64),
+                          'expense': amount.lt(0).astype(np.int64)})
+    return frame.groupby(['user_id', 'month', 'transaction_type']).agg(
+        transaction_count=('transaction_amount', 'count'),
+        amount_sum=('transaction_amount', 'sum'),
+        income_count=('income', 'sum'),
+        expense_count=('expense', 'sum'),
+    ).reset_index()
+
+
+def features_from_aggregates(aggregates, months=6):
+    '''
+    Function rolls partial aggregates (e.g. one row per user, month and transaction type) up into the
+    user_transaction_features of build_features over the same transactions
+    :param aggregates: dataframe of (user_id, transaction_type, transaction_count, amount_sum, income_count,
+                       expense_count)
+    :param months: number of months of the window (int)
+    :return: dataframe of one row per user_id
+    '''
+    by_type = aggregates.groupby(['user_id', 'transaction_type'])[
+        ['transaction_count', 'amount_sum', 'income_count', 'expense_count']].sum()
+    totals = by_type.groupby('user_id').sum()
+    aggregated_data = pd.DataFrame({'total_transactions': totals['transaction_count'],
+                                    'total_income_transactions': totals['income_count'],
+                                    'total_expense_transactions': totals['expense_count'],
+                                    'total_transaction_amount': totals['amount_sum'],
+                                    'avg_transaction_amount': totals['amount_sum'] / totals['transaction_count']}
+                                   ).reset_index()
+    by_type['avg_transaction_amount'] = by_type['amount_sum'] / by_type['transaction_count']
+    return _assemble_features(aggregated_data, by_type, months)
+
+
+def legacy_features(user_transactions, months=6):
+    '''
+    Function builds user_transaction_features with the original task2 code (lambdas and groupby().apply), kept as
+    the reference of the parity check
+    '''
+    aggregated_data = user_transactions.groupby(['user_id']).agg(
+        total_transactions=('transaction_amount', 'count'),
+        total_income_transactions=('transaction_amount', lambda x: (x > 0).sum()),
+        total_expense_transactions=('transaction_amount', lambda x: (x < 0).sum()),
+        total_transaction_amount=('transaction_amount', 'sum'),
+        avg_transaction_amount=('transaction_amount', 'mean'),
+    ).reset_index()
+
+    avg_transaction_by_type = user_transactions.groupby(['user_id', 'transaction_type']).agg(
+        avg_transaction_amount=('transaction_amount', 'mean'),
+        transaction_count=('transaction_amount', 'count')
+    ).reset_index()
+    avg_transaction_pivot = avg_transaction_by_type.pivot(index='user_id',
+                                                          columns='transaction_type',
+                                                          values=['avg_transaction_amount', 'transaction_count'])
+    avg_transaction_pivot.columns = [f'{stat}_{trans_type}' for stat, trans_type in avg_transaction_pivot.columns]
+    avg_transaction_pivot = avg_transaction_pivot.reset_index()
+
+    def count_consecutive_transactions(x):
+        x['consecutive_flag'] = (x['transaction_type'] != x['transaction_type'].shift()).cumsum()
+        consecutive_count = x.groupby(['transaction_type', 'consecutive_flag']).size().groupby('transaction_type').sum()
+        return consecutive_count / months
+
+    consecutive_transactions = user_transactions.groupby('user_id').apply(count_consecutive_transactions,
+                                                                          include_groups=False).reset_index()
+    consecutive_pivot = consecutive_transactions.pivot(index='user_id', columns='transaction_type', values=0)
+    consecutive_pivot.columns = [f'consecutive_{trans_type}_pct' for trans_type in consecutive_pivot.columns]
+    consecutive_pivot = consecutive_pivot.reset_index()
+
+    user_transaction_features = aggregated_data.merge(avg_transaction_pivot, on='user_id', how='left')
+    return user_transaction_features.merge(consecutive_pivot, on='user_id', how='left')
+
+
+def synthetic_user_transactions(n_transactions, n_users=None, seed=0):
+    '''
+    Function creates synthetic user transactions (user_id as str, as in task2) for the parity check and benchmark
+    :param n_transactions: number of transactions (int)
+    :param n_users: number of users (int), one per 100 transactions if None
+    :param seed: random seed (int)
+    :return: dataframe of (transaction_id, user_id, transaction_date, transaction_type, transaction_amount)
+    '''
+    rng = np.random.default_rng(seed)
+    n_users = n_users or max(n_transactions // 100, 1)
+    users = rng.integers(1, n_users + 1, n_transactions)
+    # each user has up to 4 of the types, so some features are missing as in the sample data (the legacy
+    # groupby().apply also returns a differently shaped frame when every user has the same set of types)
+    codes = (users * 3 + rng.integers(0, 4, n_transactions)) % len(TRANSACTION_TYPES)
+    types = pd.Categorical.from_codes(codes, TRANSACTION_TYPES)
+    return pd.DataFrame({'transaction_id': np.arange(n_transactions),
+                         'user_id': users.astype(str),
+                         'transaction_date': pd.Timestamp('2023-04-01') +
+                         pd.to_timedelta(rng.integers(0, 183, n_transactions), unit='D'),
+                         'transaction_type': np.asarray(types, dtype=object),
+                         'transaction_amount': np.round(rng.normal(0, 2000, n_transactions), 2)})
+
+
+def check_parity(user_transactions, months=6):
+    '''
+    Function checks build_features, and the roll-up of its monthly partial aggregates, against legacy_features
+    (same columns, values within float tolerance)
+    '''
+    expected = legacy_features(user_transactions.copy(), months)
+    result = build_features(user_transactions, months)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+    if 'transaction_date' in user_transactions:
+        rolled_up = features_from_aggregates(month_aggregates(user_transactions), months)
+        pd.testing.assert_frame_equal(rolled_up, expected, check_dtype=False, rtol=1e-9)
+    return result
+
+
+def benchmark_features(sizes, legacy_max_rows=10 ** 6, repeat=1, seed=0):
+    '''
+    Function times build_features against legacy_features on synthetic transactions
+    :param sizes: numbers of transactions (list of int)
+    :param legacy_max_rows: larger sizes only run build_features, the legacy code takes minutes (int)
+    :param repeat: number of runs, the fastest is kept (int)
+    :param seed: random seed (int)
+    :return: list of dict (rows, build_seconds, legacy_seconds, speedup)
+    '''
+    results = []
+    for n in sizes:
+        user_transactions = synthetic_user_transactions(n, seed=seed)
+        timings = {}
+        for name, function in [('build', build_features), ('legacy', legacy_features)]:
+            if name == 'legacy' and n > legacy_max_rows:
+                timings[name] = None
+                continue
+            best = np.inf
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function(user_transactions.copy() if name == 'legacy' else user_transactions)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+        speedup = timings['legacy'] / timings['build'] if timings['legacy'] else None
+        results.append({'rows': n, 'build_seconds': timings['build'], 'legacy_seconds': timings['legacy'],
+                        'speedup': speedup})
+        print(f"{n} transactions: build_features {timings['build']:.2f} seconds" +
+              (f", legacy {timings['legacy']:.2f} seconds ({speedup:.0f}x)" if timings['legacy'] else ''))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7], type=int, nargs='+',
+                        help='numbers of transactions of the benchmark')
+    parser.add_argument('--legacy-max-rows', default=10 ** 6, type=int, help='largest size the legacy code runs on')
+    parser.add_argument('--repeat', default=1, type=int, help='number of runs per size')
+    args = parser.parse_args()
+
+    # Check: parity with the original task2 code on synthetic data
+    check_parity(synthetic_user_transactions(20000, n_users=150))
+    print("build_features and features_from_aggregates match the original task2 features")
+    benchmark_features(args.sizes, args.legacy_max_rows, args.repeat)
+
+    # python features.py --sizes 10000 100000 1000000 10000000
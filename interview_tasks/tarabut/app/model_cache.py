@@ -0,0 +1,125 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+
+# directory the trained models are persisted to (docker-compose volume), and its size cap
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), '.model_cache'))
+MODEL_CACHE_MAX_BYTES = int(os.environ.get('MODEL_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+ARTIFACT_SUFFIX = '.joblib'
+
+logger = logging.getLogger(__name__)
+
+
+def data_hash(*objects):
+    '''
+    Function returns a content hash of the training data: dataframes, series and arrays by their values, index and
+    dtypes, other objects by their JSON (or repr)
+    :param objects: training data (dataframe, series, array or JSON serialisable objects)
+    :return: hex digest (str)
+    '''
+    digest = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+            columns = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+            digest.update(repr((list(columns), [str(dtype) for dtype in np.atleast_1d(obj.dtypes)])).encode())
+        elif isinstance(obj, np.ndarray):
+            digest.update(repr((obj.shape, str(obj.dtype))).encode())
+            digest.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            digest.update(json.dumps(obj, sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+def code_version(*functions):
+    '''
+    Function returns a hash of the source code of the functions (or modules, classes) building an artifact, so
+    changing the training code invalidates its cached models
+    '''
+    return hashlib.sha256(''.join(inspect.getsource(function) for function in functions).encode()).hexdigest()
+
+
+def artifact_key(name, data=(), params=None, code=()):
+    '''
+    Function returns the content address of an artifact: a hash of its name, training data, hyperparameters and
+    code version
+    :param name: artifact name (str)
+    :param data: training data (tuple of dataframe, series, array)
+    :param params: hyperparameters (JSON serialisable)
+    :param code: functions building the artifact (tuple)
+    :return: key (str)
+    '''
+    parts = [name, data_hash(*data), json.dumps(params, sort_keys=True, default=repr), code_version(*code)]
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+
+
+def evict(cache_dir=MODEL_CACHE_DIR, max_bytes=MODEL_CACHE_MAX_BYTES):
+    '''
+    Function removes the least recently used artifacts (oldest modification time, touched on every hit) until the
+    cache fits in max_bytes
+    :return: number of artifacts removed (int)
+    '''
+    artifacts = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(ARTIFACT_SUFFIX):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+    total, removed = sum(size for _, size, _ in artifacts), 0
+    for _, size, path in sorted(artifacts):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
+
+
+def cached_artifact(name, build, data=(), params=None, code=(), cache_dir=MODEL_CACHE_DIR,
+                    max_bytes=MODEL_CACHE_MAX_BYTES, mmap_mode='r'):
+    '''
+    Function returns a trained artifact (model, scaler, fitted results ...) from the disk cache, or builds and
+    stores it. Artifacts are content addressed (see artifact_key), so any process with the same data, hyperparameters
+    and code reuses them, also after a restart. Large arrays are memory mapped on load rather than read into memory.
+    The cache is kept under max_bytes by evicting the least recently used artifacts
+    :param name: artifact name (str)
+    :param build: function returning the artifact, called on a cache miss
+    :param data: training data, part of the key (tuple of dataframe, series, array)
+    :param params: hyperparameters, part of the key (JSON serialisable)
+    :param code: functions building the artifact, part of the key (tuple)
+    :param cache_dir: cache directory (str)
+    :param max_bytes: size cap of the cache (int)
+    :param mmap_mode: joblib memory map mode of the arrays, None to read them into memory (str)
+    :return: artifact
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{name}-{artifact_key(name, data, params, code)}{ARTIFACT_SUFFIX}")
+    try:
+        artifact = joblib.load(path, mmap_mode=mmap_mode)
+        os.utime(path)  # most recently used
+        return artifact
+    except FileNotFoundError:
+        pass
+    except Exception as error:  # truncated or written by an incompatible library version: rebuild it
+        logger.warning("Rebuilding model artifact %s: %s", path, error)
+
+    start = time.perf_counter()
+    artifact = build()
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(artifact, tmp_file)
+    os.replace(tmp_file, path)  # atomic, concurrent readers never load a partial artifact
+    evict(cache_dir, max_bytes)
+    logger.info("Model artifact %s built and cached in %.2f seconds", name, time.perf_counter() - start)
+    return artifact
@@ -0,0 +1,267 @@
+import collections
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from sqlalchemy import text
+from db import get_engine, typed_frame
+
+PAGE_ROWS = 1000
+MAX_ROWS = 100000  # rows a query can load in total, the rest is not fetched
+TIMEOUT_SECONDS = 30  # statement_timeout of each statement (the query, then each page fetched)
+RESULT_CACHE_ENTRIES = 32
+OPEN_RUNS = 8  # runs holding a cursor at once, the least recently used is closed beyond
+IDLE_SECONDS = 600  # a run without a page fetched for longer is closed, its cursor and connection released
+
+# fetches run in background threads, so the page stays responsive and a running query can be cancelled
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='query_runner')
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+_runs = collections.OrderedDict()  # runs holding a cursor, least recently used first
+_runs_lock = threading.Lock()
+# single quoted literals, double quoted identifiers and comments, in which ; and whitespace are kept as they are
+_TOKENS = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/)", re.S)
+
+
+def normalize_sql(sql):
+    '''
+    Function normalizes a query for the result cache: whitespace outside literals collapsed, comments and the final
+    semicolon removed. Only one statement is accepted
+    :param sql: query (str)
+    :return: normalized query (str)
+    '''
+    parts = []
+    for i, part in enumerate(_TOKENS.split(sql)):
+        if i % 2:
+            parts.append(' ' if part.startswith(('--', '/*')) else part)
+        else:
+            parts.append(re.sub(r'\s+', ' ', part))
+    normalized = ''.join(parts).strip().rstrip(';').strip()
+    if not normalized:
+        raise ValueError("Enter a query")
+    if any(';' in part for part in _TOKENS.split(normalized)[::2]):
+        raise ValueError("Only one statement can be run at a time")
+    return normalized
+
+
+def data_version(engine=None):
+    '''
+    Function returns the version of the data: the last load recorded in ingest_state and the last feature_version,
+    None if unknown (results are then not cached)
+    '''
+    try:
+        with (engine or get_engine()).connect() as connection:
+            return connection.execute(text(
+                """SELECT (SELECT max(loaded_at)::text FROM ingest_state) || '/' ||
+                          COALESCE((SELECT max(feature_version)::text FROM feature_versions), '-')""")).scalar()
+    except Exception:
+        return None
+
+
+def _read_only_transaction(cursor, timeout_seconds):
+    '''
+    Function starts a read only transaction with a statement timeout, and returns the backend pid
+    '''
+    cursor.execute("SET TRANSACTION READ ONLY")
+    cursor.execute("SELECT set_config('statement_timeout', %s, true), pg_backend_pid()",
+                   (str(int(timeout_seconds * 1000)),))
+    return cursor.fetchone()[1]
+
+
+def explain(sql, analyze=False, timeout_seconds=TIMEOUT_SECONDS, engine=None):
+    '''
+    Function returns the plan of a query, with EXPLAIN ANALYZE its actual run times and buffers. The query is run in
+    a read only transaction that is rolled back, bound by the statement timeout
+    :param sql: query (str)
+    :param analyze: run the query (bool)
+    :param timeout_seconds: statement timeout (int)
+    :param engine: SQLAlchemy engine, the pooled engine of the process if None
+    :return: plan (str)
+    '''
+    sql = normalize_sql(sql)
+    connection = (engine or get_engine()).raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            _read_only_transaction(cursor, timeout_seconds)
+            cursor.execute(f"EXPLAIN ({'ANALYZE, BUFFERS, ' if analyze else ''}FORMAT TEXT) {sql}")
+            return '\n'.join(row[0] for row in cursor.fetchall())
+    finally:
+        connection.rollback()
+        connection.close()  # back to the pool
+
+
+class QueryRun:
+    '''
+    Class runs an ad hoc query safely: in a read only transaction with a statement timeout, through a server side
+    cursor that fetches a page of rows at a time (at most max_rows in total), cancellable while it runs. The query is
+    run once, by a WITH HOLD cursor on a connection detached from the pool: the cursor outlives the transaction of
+    each page, so every page comes from the same result and a run left open in a session holds neither a transaction
+    nor a pooled connection. At most OPEN_RUNS runs hold a cursor, runs idle for IDLE_SECONDS are closed (a closed
+    run runs its query again on the next page). Complete and partial results are cached per normalized query and
+    data version, a cached page is shown without querying
+    '''
+    def __init__(self, sql, page_rows=PAGE_ROWS, timeout_seconds=TIMEOUT_SECONDS, max_rows=MAX_ROWS, engine=None):
+        self.sql = normalize_sql(sql)
+        self.page_rows, self.timeout_seconds, self.max_rows = page_rows, timeout_seconds, max_rows
+        self.engine = engine or get_engine()
+        self.version = data_version(self.engine)
+        self.key = (self.sql, self.version)
+        self.frame, self.complete, self.from_cache = None, False, False
+        self.connection, self.cursor, self.pid, self.future = None, None, None, None
+        self.error, self.seconds, self.last_used = None, 0.0, time.monotonic()
+        self._lock = threading.Lock()  # held while a page is fetched, an idle run is only closed when free
+
+        cached = self._cached()
+        if cached is not None:
+            self.frame, self.complete, self.from_cache = cached[0], cached[1], True
+
+    def _cached(self):
+        if self.version is None:
+            return None
+        with _cache_lock:
+            if self.key in _cache:
+                _cache.move_to_end(self.key)
+                return _cache[self.key]
+        return None
+
+    def _store(self):
+        if self.version is None or self.frame is None:
+            return
+        with _cache_lock:
+            cached = _cache.get(self.key)
+            if cached is None or len(self.frame) >= len(cached[0]):
+                _cache[self.key] = (self.frame, self.complete)
+                _cache.move_to_end(self.key)
+            while len(_cache) > RESULT_CACHE_ENTRIES:
+                _cache.popitem(last=False)
+
+    @property
+    def rows(self):
+        return 0 if self.frame is None else len(self.frame)
+
+    @property
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+    @property
+    def can_fetch(self):
+        return not self.complete and self.error is None and self.rows < self.max_rows
+
+    def _open(self):
+        '''
+        Function declares the WITH HOLD cursor of the run, limited to max_rows, on a connection detached from the pool
+        '''
+        _release_runs(self)
+        connection = self.engine.raw_connection()
+        connection.detach()  # closed with the run, the pool opens a new connection in its place
+        self.connection = connection
+        with connection.cursor() as cursor:
+            self.pid = _read_only_transaction(cursor, self.timeout_seconds)
+        self.cursor = connection.cursor(name=f"query_runner_{uuid.uuid4().hex}", withhold=True)
+        self.cursor.itersize = self.page_rows
+        self.cursor.execute(f"SELECT * FROM ({self.sql}) AS query_run LIMIT {int(self.max_rows)}")
+        with _runs_lock:
+            _runs[self] = None
+
+    def _fetch_page(self):
+        start = time.perf_counter()
+        with self._lock:
+            try:
+                frame, requested = self.frame, min(self.page_rows, self.max_rows - self.rows)
+                if self.cursor is None:
+                    # the rows already loaded (from the result cache, or before a cancel or close) are fetched again,
+                    # so every row comes from this cursor
+                    frame, requested = None, min(self.rows + self.page_rows, self.max_rows)
+                    self._open()
+                else:
+                    with self.connection.cursor() as cursor:
+                        self.pid = _read_only_transaction(cursor, self.timeout_seconds)
+                records = self.cursor.fetchmany(requested)
+                columns = [column[0] for column in self.cursor.description]
+                # the first commit stores the rest of the result in the cursor, later ones end the FETCH transaction
+                self.connection.commit()
+                page = typed_frame(pd.DataFrame(records, columns=columns))
+                self.frame = page if frame is None else typed_frame(pd.concat([frame, page], ignore_index=True))
+                self.complete, self.from_cache = len(records) < requested, False
+                self._store()
+                if not self.can_fetch:
+                    self.close()
+            except Exception as error:
+                self.error = error
+                self.close()
+            finally:
+                self.seconds += time.perf_counter() - start
+                self.last_used = time.monotonic()
+                with _runs_lock:
+                    if self in _runs:
+                        _runs.move_to_end(self)
+
+    def fetch(self):
+        '''
+        Function fetches the next page in the background, poll running or wait() for it
+        '''
+        if self.can_fetch and not self.running:
+            self.future = _executor.submit(self._fetch_page)
+        return self.future
+
+    def wait(self, poll_seconds=0.2, on_poll=None):
+        '''
+        Function waits for the running fetch, calling on_poll(seconds elapsed) every poll_seconds (for Streamlit, an
+        element update lets a click on Cancel interrupt the wait)
+        '''
+        start = time.perf_counter()
+        while self.running:
+            if on_poll is not None:
+                on_poll(time.perf_counter() - start)
+            time.sleep(poll_seconds)
+
+    def cancel(self):
+        '''
+        Function cancels the running statement from another pooled connection (pg_cancel_backend) and closes the
+        cursor, the rows already loaded are kept and more can be fetched again (by running the query again)
+        '''
+        if self.running:
+            if self.pid is not None:
+                with self.engine.connect() as connection:
+                    connection.execute(text("SELECT pg_cancel_backend(:pid)"), {'pid': self.pid})
+            self.future.result()  # the fetch fails with QueryCanceled (or completes) before the connection is closed
+            self.error = None
+        self.close()
+
+    def close(self):
+        '''
+        Function closes the cursor and its connection
+        '''
+        cursor, connection = self.cursor, self.connection
+        self.cursor, self.connection, self.pid = None, None, None
+        with _runs_lock:
+            _runs.pop(self, None)
+        if connection is None:
+            return
+        try:
+            if cursor is not None:
+                cursor.close()
+            connection.rollback()
+        except Exception:
+            pass  # broken (e.g. the server connection was lost), closed all the same
+        finally:
+            connection.close()  # detached from the pool: the server connection is closed
+
+
+def _release_runs(opening):
+    '''
+    Function closes the runs idle for more than IDLE_SECONDS, and the least recently used ones beyond OPEN_RUNS,
+    before the run opening declares its cursor. A run fetching a page is never closed
+    '''
+    now = time.monotonic()
+    with _runs_lock:
+        runs = [run for run in _runs if run is not opening]
+    excess = len(runs) + 1 - OPEN_RUNS
+    for i, run in enumerate(runs):  # least recently used first
+        if (i < excess or now - run.last_used > IDLE_SECONDS) and run._lock.acquire(blocking=False):
+            try:
+                run.close()
+            finally:
+                run._lock.release()
@@ -0,0 +1,322 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import norm
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import davies_bouldin_score, silhouette_samples
+from sklearn.preprocessing import StandardScaler
+from sqlalchemy import text
+
+# number of users above which method='auto' switches from KMeans to MiniBatchKMeans
+MINIBATCH_MIN_USERS = 10000
+CLUSTERING_METHODS = ['auto', 'kmeans', 'minibatch']
+SWEEP_KS = list(range(2, 11))
+SWEEP_COLUMNS = ['k', 'inertia', 'silhouette', 'silhouette_lower', 'silhouette_upper', 'davies_bouldin', 'seconds']
+
+
+def scale_features(features, columns):
+    '''
+    Function standardises the selected features, missing features (transaction types a user does not have) are 0
+    :param features: dataframe of one row per user
+    :param columns: selected feature columns (list of str)
+    :return: scaled features (n x f array)
+    '''
+    return StandardScaler().fit_transform(features[list(columns)].fillna(0).to_numpy(dtype=np.float64))
+
+
+def fit_clusters(scaled_features, k, method='auto', batch_size=4096, random_state=42):
+    '''
+    Function clusters the users with KMeans, or with MiniBatchKMeans (fitted on mini-batches, so it scales to millions
+    of users) for large data
+    :param scaled_features: scaled features (n x f array)
+    :param k: number of clusters (int)
+    :param method: auto, kmeans or minibatch (str)
+    :param batch_size: mini-batch size of MiniBatchKMeans (int)
+    :param random_state: random seed (int)
+    :return: fitted model, cluster of each user (n array)
+    '''
+    if method == 'auto':
+        method = 'minibatch' if len(scaled_features) > MINIBATCH_MIN_USERS else 'kmeans'
+    if method == 'kmeans':
+        model = KMeans(n_clusters=k, random_state=random_state)
+    elif method == 'minibatch':
+        model = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, n_init=3, random_state=random_state)
+    else:
+        raise ValueError(f"Unknown method '{method}', expected one of {CLUSTERING_METHODS}")
+    return model, model.fit_predict(scaled_features)
+
+
+def stratified_sample(labels, sample_size, random_state=42):
+    '''
+    Function samples users in proportion to the size of their cluster, at least 2 users per cluster of 2 or more
+    :param labels: cluster of each user (n array)
+    :param sample_size: number of users to sample (int)
+    :param random_state: random seed (int)
+    :return: positions of the sampled users (array)
+    '''
+    if len(labels) <= sample_size:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(random_state)
+    clusters, counts = np.unique(labels, return_counts=True)
+    allocation = np.minimum(np.maximum(np.round(sample_size * counts / len(labels)).astype(int), 2), counts)
+    return np.sort(np.concatenate([rng.choice(np.flatnonzero(labels == cluster), size, replace=False)
+                                   for cluster, size in zip(clusters, allocation)]))
+
+
+def sampled_silhouette(scaled_features, labels, sample_size=2000, reference_size=50000, confidence=0.95,
+                       random_state=42):
+    '''
+    Function estimates the silhouette score from a stratified sample of users: the mean distances of each sampled
+    user to the clusters are measured on a stratified reference sample of users (O(sample x reference) rather than
+    O(n^2), exact when reference_size >= n), and the score is the cluster size weighted mean of the per cluster sample
+    means, with a normal confidence interval (finite population corrected)
+    :param scaled_features: scaled features (n x f array)
+    :param labels: cluster of each user (n array)
+    :param sample_size: number of users whose silhouette is computed (int)
+    :param reference_size: number of users the distances are measured to (int)
+    :param confidence: confidence level of the interval, between 0 and 1 (float)
+    :param random_state: random seed (int)
+    :return: dict (score, standard_error, lower, upper, sample (positions), values (silhouette of the sample))
+    '''
+    if not 0 < confidence < 1:
+        raise ValueError(f"confidence must be between 0 and 1, got {confidence}")
+    sample = stratified_sample(labels, sample_size, random_state)
+    reference = stratified_sample(labels, reference_size, random_state + 1)
+    values = np.empty(len(sample))
+    block_size = max(1, 10 ** 7 // len(reference))  # bounded memory: at most 10^7 distances at a time
+    for start in range(0, len(sample), block_size):
+        block = sample[start:start + block_size]
+        values[start:start + len(block)] = _silhouette_of(scaled_features, labels, block, reference)
+
+    n = len(labels)
+    score, variance = 0.0, 0.0
+    for cluster in np.unique(labels):
+        population = np.count_nonzero(labels == cluster)
+        weight = population / n
+        cluster_values = values[labels[sample] == cluster]
+        score += weight * cluster_values.mean()
+        if len(cluster_values) > 1:
+            fpc = 1 - len(cluster_values) / population
+            variance += weight ** 2 * cluster_values.var(ddof=1) / len(cluster_values) * fpc
+    standard_error = math.sqrt(variance)
+    z = norm.ppf(0.5 + confidence / 2)
+    return {'score': score, 'standard_error': standard_error, 'lower': score - z * standard_error,
+            'upper': score + z * standard_error, 'sample': sample, 'values': values}
+
+
+def _silhouette_of(scaled_features, labels, positions, reference):
+    '''
+    Function returns the silhouette of the users at positions, with the mean distances to each cluster measured on
+    the reference users (as silhouette_samples when reference is every user)
+    '''
+    points, others = scaled_features[positions], scaled_features[reference]
+    distances = np.sqrt(np.maximum(
+        (points ** 2).sum(axis=1)[:, None] + (others ** 2).sum(axis=1)[None, :] - 2 * points @ others.T, 0))
+    clusters, inverse = np.unique(labels, return_inverse=True)
+    # summed distances to the reference users of each cluster, as one product with the one-hot cluster matrix
+    one_hot = np.zeros((len(reference), len(clusters)))
+    one_hot[np.arange(len(reference)), inverse[reference]] = 1
+    sums, counts = distances @ one_hot, one_hot.sum(axis=0)
+    rows, own = np.arange(len(positions)), inverse[positions]
+    own_count = counts[own] - np.isin(positions, reference)  # a user is not compared with itself
+    a = sums[rows, own] / np.maximum(own_count, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_other = sums / counts
+    mean_other[rows, own] = np.inf
+    b = mean_other.min(axis=1)
+    silhouette = (b - a) / np.maximum(a, b)
+    return np.where(own_count > 0, np.nan_to_num(silhouette), 0)  # 0 for clusters of one user, as sklearn
+
+
+def project_2d(scaled_features, batch_size=10000):
+    '''
+    Function projects the features on their first 2 principal components with IncrementalPCA, fitted batch by batch
+    so memory stays bounded
+    :return: (n x 2 array)
+    '''
+    n_components = min(2, scaled_features.shape[1])
+    pca = IncrementalPCA(n_components=n_components, batch_size=max(batch_size, n_components))
+    for start in range(0, len(scaled_features), batch_size):
+        batch = scaled_features[start:start + batch_size]
+        if len(batch) >= n_components:
+            pca.partial_fit(batch)
+    return pca.transform(scaled_features)
+
+
+def feature_importance(features, columns, labels, n_estimators=100, max_samples=10000, random_state=42):
+    '''
+    Function ranks the features by how well they explain the clusters (random forest feature importance), the
+    forest is fitted on at most max_samples users
+    :return: dataframe of (feature, importance) sorted by importance
+    '''
+    X = features[list(columns)].fillna(0)
+    sample = stratified_sample(labels, max_samples, random_state)
+    rf_model = RandomForestClassifier(n_estimators=n_estimators, random_state=random_state, n_jobs=-1)
+    rf_model.fit(X.iloc[sample], labels[sample])
+    return pd.DataFrame({'feature': list(columns), 'importance': rf_model.feature_importances_}
+                        ).sort_values(by='importance', ascending=False)
+
+
+def segment_users(features, columns, k, method='auto', silhouette_sample=2000, random_state=42):
+    '''
+    Function runs the task3 segmentation: scaling, clustering, 2d projection, sampled silhouette and feature importance
+    :param features: dataframe of one row per user with user_id and the feature columns
+    :param columns: selected feature columns (list of str)
+    :param k: number of clusters (int)
+    :param method: auto, kmeans or minibatch (str)
+    :param silhouette_sample: number of users sampled for the silhouette (int)
+    :param random_state: random seed (int)
+    :return: dict (model, labels, projection, silhouette, importance, seconds)
+    '''
+    start = time.perf_counter()
+    scaled_features = scale_features(features, columns)
+    model, labels = fit_clusters(scaled_features, k, method, random_state=random_state)
+    return {'model': model, 'labels': labels, 'projection': project_2d(scaled_features),
+            'silhouette': sampled_silhouette(scaled_features, labels, silhouette_sample, random_state=random_state),
+            'importance': feature_importance(features, columns, labels, random_state=random_state),
+            'seconds': time.perf_counter() - start}
+
+
+def feature_set_hash(columns):
+    '''
+    Function returns a stable hash of a feature set, independent of the order the features were selected in
+    '''
+    return hashlib.sha256(json.dumps(sorted(columns)).encode()).hexdigest()[:16]
+
+
+def score_k(scaled_features, k, method='auto', silhouette_sample=2000, random_state=42):
+    '''
+    Function fits one k of the sweep and scores it
+    :return: dict (k, inertia, silhouette, silhouette_lower, silhouette_upper, davies_bouldin, seconds)
+    '''
+    start = time.perf_counter()
+    model, labels = fit_clusters(scaled_features, k, method, random_state=random_state)
+    silhouette = sampled_silhouette(scaled_features, labels, silhouette_sample, random_state=random_state)
+    return {'k': k, 'inertia': float(model.inertia_), 'silhouette': silhouette['score'],
+            'silhouette_lower': silhouette['lower'], 'silhouette_upper': silhouette['upper'],
+            'davies_bouldin': davies_bouldin_score(scaled_features, labels), 'seconds': time.perf_counter() - start}
+
+
+def sweep_k(features, columns, ks=SWEEP_KS, method='auto', n_jobs=None, random_state=42):
+    '''
+    Function fits every k in parallel worker processes (the scaled features are shared with the workers through a
+    memory map rather than copied) and returns the scores of the elbow plot
+    :param features: dataframe of one row per user
+    :param columns: selected feature columns (list of str)
+    :param ks: numbers of clusters (list of int)
+    :param method: auto, kmeans or minibatch (str)
+    :param n_jobs: number of worker processes (int), one per core if None
+    :param random_state: random seed (int)
+    :return: dataframe of SWEEP_COLUMNS, one row per k
+    '''
+    scaled_features = scale_features(features, columns)
+    n_jobs = n_jobs or min(len(ks), os.cpu_count() or 1)
+    scores = Parallel(n_jobs=n_jobs)(delayed(score_k)(scaled_features, k, method, random_state=random_state)
+                                     for k in ks)
+    return pd.DataFrame(scores, columns=SWEEP_COLUMNS)
+
+
+def read_sweep(connection, feature_hash, data_version, method):
+    '''
+    Function returns the stored sweep of a feature set and data version, empty if it was never run
+    '''
+    return pd.read_sql(text(f"""SELECT {', '.join(SWEEP_COLUMNS)} FROM kmeans_sweeps
+                                WHERE feature_set_hash = :hash AND data_version = :version AND method = :method
+                                ORDER BY k"""), connection,
+                       params={'hash': feature_hash, 'version': data_version, 'method': method})
+
+
+def store_sweep(connection, feature_hash, data_version, method, sweep):
+    '''
+    Function stores the scores of a sweep, replacing the stored scores of the same ks
+    '''
+    updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in SWEEP_COLUMNS if column != 'k')
+    connection.execute(text(f"""INSERT INTO kmeans_sweeps (feature_set_hash, data_version, method,
+                                                           {', '.join(SWEEP_COLUMNS)})
+                                VALUES (:hash, :version, :method, {', '.join(':' + c for c in SWEEP_COLUMNS)})
+                                ON CONFLICT (feature_set_hash, data_version, method, k)
+                                DO UPDATE SET {updates}, created_at = now()"""),
+                       [dict(row, hash=feature_hash, version=data_version, method=method)
+                        for row in sweep.astype(object).to_dict('records')])
+
+
+def cached_sweep(engine, features, columns, data_version, ks=SWEEP_KS, method='auto', refresh=False):
+    '''
+    Function returns the sweep of a feature set from the kmeans_sweeps table, and only runs (and stores) the ks
+    missing for this version of the data, or every k if refresh
+    :param engine: SQLAlchemy engine
+    :param features: dataframe of one row per user
+    :param columns: selected feature columns (list of str)
+    :param data_version: version of the features, e.g. their feature_version (str)
+    :param ks: numbers of clusters (list of int)
+    :param method: auto, kmeans or minibatch (str)
+    :param refresh: run every k again (bool)
+    :return: dataframe of SWEEP_COLUMNS, one row per k
+    '''
+    feature_hash = feature_set_hash(columns)
+    with engine.connect() as connection:
+        stored = read_sweep(connection, feature_hash, data_version, method)
+    stored = stored[stored['k'].isin(ks)]
+    missing = list(ks) if refresh else [k for k in ks if k not in set(stored['k'])]
+    if not missing:
+        return stored.reset_index(drop=True)
+    sweep = sweep_k(features, columns, missing, method)
+    with engine.begin() as connection:
+        store_sweep(connection, feature_hash, data_version, method, sweep)
+    stored = stored[~stored['k'].isin(missing)]
+    return pd.concat([stored, sweep], ignore_index=True).sort_values('k').reset_index(drop=True)
+
+
+def synthetic_features(n_users, n_features=20, k=3, seed=0):
+    '''
+    Function creates synthetic user features with k groups, for the benchmark
+    '''
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 3, (k, n_features))
+    values = centres[rng.integers(0, k, n_users)] + rng.normal(0, 1, (n_users, n_features))
+    features = pd.DataFrame(values, columns=[f'feature_{i}' for i in range(n_features)])
+    features.insert(0, 'user_id', np.arange(n_users).astype(str))
+    return features
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default=[1000, 10000, 100000], type=int, nargs='+', help='numbers of users')
+    parser.add_argument('--k', default=3, type=int, help='number of clusters')
+    parser.add_argument('--sample', default=2000, type=int, help='users sampled for the silhouette')
+    parser.add_argument('--sweep', action='store_true', help='also time the k-sweep, serial against parallel')
+    args = parser.parse_args()
+
+    # Check: the sampled silhouette of every user equals silhouette_samples
+    features = synthetic_features(1500, k=args.k)
+    columns = features.columns.drop('user_id')
+    scaled = scale_features(features, columns)
+    labels = fit_clusters(scaled, args.k)[1]
+    exact = silhouette_samples(scaled, labels)
+    estimate = sampled_silhouette(scaled, labels, sample_size=len(labels))
+    assert np.allclose(estimate['values'], exact, atol=1e-8) and np.isclose(estimate['score'], exact.mean())
+    print("sampled_silhouette matches silhouette_samples")
+
+    for n_users in args.users:
+        features = synthetic_features(n_users, k=args.k)
+        result = segment_users(features, features.columns.drop('user_id'), args.k, silhouette_sample=args.sample)
+        silhouette = result['silhouette']
+        print(f"{n_users} users: {type(result['model']).__name__} segmentation in {result['seconds']:.2f} seconds, "
+              f"silhouette {silhouette['score']:.3f} ({silhouette['lower']:.3f} - {silhouette['upper']:.3f})")
+        if args.sweep:
+            for n_jobs in (1, None):
+                start = time.perf_counter()
+                sweep = sweep_k(features, features.columns.drop('user_id'), n_jobs=n_jobs)
+                print(f"{n_users} users: k-sweep {SWEEP_KS[0]}-{SWEEP_KS[-1]} with {n_jobs or os.cpu_count()} "
+                      f"processes in {time.perf_counter() - start:.2f} seconds, best silhouette at "
+                      f"k={sweep.loc[sweep['silhouette'].idxmax(), 'k']}")
+
+    # python segmentation.py --users 1000 10000 100000 1000000 --sweep
@@ -0,0 +1,104 @@
+import datetime
+import json
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from db import query_frame
+
+# directory the reader writes the Parquet snapshots to (docker-compose volume)
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '/snapshots')
+MANIFEST_FILE = 'manifest.json'
+
+# DATE columns, returned as datetime64 whether read from a snapshot or from PostgreSQL
+DATE_COLUMNS = ['consent_granted_date', 'transaction_date']
+
+# filter operators understood by both pyarrow and the PostgreSQL fallback
+OPERATORS = {'==': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>=', 'in': '= ANY'}
+
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    '''
+    Function returns the manifest of the latest snapshot, None if there is none
+    '''
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def database_version(engine):
+    '''
+    Function returns the version of the data in the database (time of the last load), None if unknown
+    '''
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text("SELECT max(loaded_at)::text FROM ingest_state")).scalar()
+    except Exception:
+        return None
+
+
+def fresh_snapshot(engine, table, snapshot_dir=SNAPSHOT_DIR):
+    '''
+    Function returns the manifest entry of the snapshot of a table if it is as recent as the database, None otherwise
+    '''
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None or table not in manifest['tables'] or manifest['version'] is None:
+        return None
+    if manifest['version'] != database_version(engine):
+        return None
+    return manifest['tables'][table]
+
+
+def partition_filters(filters, partitioning):
+    '''
+    Function derives filters on the month partition column from filters on transaction_date, so only the partitions
+    of the requested months are opened
+    '''
+    if partitioning is None:
+        return []
+    derived = []
+    for column, op, value in filters:
+        if column == 'transaction_date' and op in ('==', '<', '<=', '>', '>='):
+            month = pd.Timestamp(value).strftime('%Y-%m')
+            derived.append((partitioning, {'==': '==', '<': '<=', '<=': '<=', '>': '>=', '>=': '>='}[op], month))
+    return derived
+
+
+def load_table(engine, table, columns=None, filters=None, snapshot_dir=SNAPSHOT_DIR):
+    '''
+    Function loads a table from its Parquet snapshot, reading only the requested columns and the row groups /
+    partitions matching the filters, and falls back to PostgreSQL if the snapshot (or the table's file) is missing or
+    stale
+    :param engine: SQLAlchemy engine
+    :param table: table name (str)
+    :param columns: columns to load (list of str), every column if None
+    :param filters: row filters (list of (column, operator, value) with operator in ==, !=, <, <=, >, >=, in)
+    :param snapshot_dir: snapshot directory (str)
+    :return: dataframe
+    '''
+    filters = [(column, op, pd.Timestamp(value).date() if isinstance(value, datetime.date) else value)
+               for column, op, value in (filters or [])]
+    snapshot = fresh_snapshot(engine, table, snapshot_dir)
+    path = None if snapshot is None else os.path.join(snapshot_dir, snapshot['path'])
+    if path is not None and os.path.exists(path):  # a table missing from the snapshot directory reads as stale
+        arrow_table = pq.read_table(path, columns=columns, memory_map=True, partitioning='hive',
+                                    filters=(filters + partition_filters(filters, snapshot['partitioning'])) or None)
+        if columns is None and snapshot['partitioning'] is not None:
+            arrow_table = arrow_table.drop([snapshot['partitioning']])
+        # split_blocks / self_destruct: avoid consolidating the columns into a copy, free the arrow buffers as we go
+        return arrow_table.to_pandas(date_as_object=False, split_blocks=True, self_destruct=True)
+
+    where, params = [], {}
+    for i, (column, op, value) in enumerate(filters):
+        where.append(f"{column} {OPERATORS[op]}(:p{i})" if op == 'in' else f"{column} {OPERATORS[op]} :p{i}")
+        params[f"p{i}"] = list(value) if op == 'in' else value
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    frame = query_frame(query, params, engine=engine)
+    for column in DATE_COLUMNS:
+        if column in frame:
+            frame[column] = pd.to_datetime(frame[column])
+    return frame
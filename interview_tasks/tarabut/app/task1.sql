@@ -35,11 +35,9 @@ FROM
                 COUNT(CASE WHEN TRANSACTION_AMOUNT < 0 THEN 1 END) AS DEBIT_TRANSACTION_COUNT,
                 SUM(CASE WHEN TRANSACTION_AMOUNT < 0 THEN TRANSACTION_AMOUNT END) AS TOTAL_DEBIT_AMOUNT,
                 COUNT(CASE WHEN TRANSACTION_AMOUNT > 0 THEN 1 END) AS CREDIT_TRANSACTION_COUNT,
-                SUM(CASE WHEN TRANSACTION_AMOUNT > 0 THEN TRANSACTION_AMOUNT END) AS TOTAL_CREDIT_AMOUNT,
-                STRING_AGG(DISTINCT TRANSACTION_TYPE, ', ') AS TRANSACTION_TYPES
+                SUM(CASE WHEN TRANSACTION_AMOUNT > 0 THEN TRANSACTION_AMOUNT END) AS TOTAL_CREDIT_AMOUNT
             FROM TRANSACTIONS
             GROUP BY ACCOUNT_ID
-            ORDER BY ACCOUNT_ID
     ) T ON A.ACCOUNT_ID = T.ACCOUNT_ID
 GROUP BY
     UC.USER_ID, UC.CONSENT_STATUS
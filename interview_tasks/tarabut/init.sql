@@ -26,3 +26,107 @@ CREATE TABLE IF NOT EXISTS TRANSACTIONS (
     TRANSACTION_TYPE VARCHAR(50) NOT NULL
     --FOREIGN KEY (ACCOUNT_ID) REFERENCES ACCOUNTS(ACCOUNT_ID)
     );
+
+-- INGEST_STATE TABLE SCHEMA (checksum and high-water mark of each loaded source file)
+CREATE TABLE IF NOT EXISTS INGEST_STATE (
+    SOURCE_FILE VARCHAR(255) PRIMARY KEY,
+    TABLE_NAME VARCHAR(100) NOT NULL,
+    CHECKSUM CHAR(64) NOT NULL,
+    HIGH_WATER_MARK BIGINT,
+    ROWS_LOADED BIGINT NOT NULL,
+    LOADED_AT TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+
+-- SUPPORTING INDEXES (dropped and rebuilt by the reader around each full load)
+CREATE INDEX IF NOT EXISTS accounts_user_id_idx ON ACCOUNTS (USER_ID);
+CREATE INDEX IF NOT EXISTS transactions_account_id_date_idx ON TRANSACTIONS (ACCOUNT_ID, TRANSACTION_DATE);
+CREATE INDEX IF NOT EXISTS transactions_transaction_date_idx ON TRANSACTIONS (TRANSACTION_DATE);
+
+-- USER_ACTIVITY_SUMMARY MATERIALIZED VIEW (task1.sql, refreshed concurrently by the reader after each load)
+CREATE MATERIALIZED VIEW IF NOT EXISTS USER_ACTIVITY_SUMMARY AS
+SELECT
+    UC.USER_ID,
+    UC.CONSENT_STATUS,
+    STRING_AGG(DISTINCT A.ACCOUNT_TYPE, ', ') AS ACCOUNT_TYPES,
+    STRING_AGG(DISTINCT A.BANK_NAME, ', ') AS BANKS,
+    COUNT(DISTINCT A.ACCOUNT_ID) AS TOTAL_ACCOUNTS,
+    SUM(CASE WHEN UPPER(A.ACCOUNT_STATUS) = 'OPEN' THEN 1 END) AS ACTIVE_ACCOUNTS,
+    SUM(CASE WHEN UPPER(A.ACCOUNT_STATUS) = 'CLOSED' THEN 1 END) AS CLOSED_ACCOUNTS,
+    AVG(A.ACCOUNT_BALANCE) AS AVERAGE_ACCOUNT_BALANCE,
+    MIN(A.ACCOUNT_BALANCE) AS MIN_ACCOUNT_BALANCE,
+    MAX(A.ACCOUNT_BALANCE) AS MAX_ACCOUNT_BALANCE,
+    COUNT(T.ACCOUNT_ID) AS TOTAL_TRANSACTIONS,
+    SUM(T.TOTAL_TRANSACTION_AMOUNT) AS TOTAL_TRANSACTION_AMOUNT,
+    MAX(T.LAST_TRANSACTION_DATE) AS LAST_TRANSACTION_DATE,
+    SUM(CASE WHEN T.RECENT_ACTIVITY = 1 THEN 1 ELSE 0 END) AS RECENT_ACTIVITY,
+    SUM(CASE WHEN T.INCOME_TRANSACTION = 1 THEN 1 ELSE 0 END) AS INCOME_TRANSACTION_COUNT,
+    SUM(CASE WHEN T.INCOME_TRANSACTION = 1 THEN T.INCOME_AVG_AMOUNT ELSE 0 END) AS INCOME_AVG_AMOUNT,
+    SUM(T.DEBIT_TRANSACTION_COUNT) AS DEBIT_TRANSACTION_COUNT,
+    SUM(T.TOTAL_DEBIT_AMOUNT) AS TOTAL_DEBIT_AMOUNT,
+    SUM(T.CREDIT_TRANSACTION_COUNT) AS CREDIT_TRANSACTION_COUNT,
+    SUM(T.TOTAL_CREDIT_AMOUNT) AS TOTAL_CREDIT_AMOUNT
+FROM
+    USER_CONSENTS UC
+        LEFT JOIN
+    ACCOUNTS A ON UC.USER_ID = A.USER_ID
+        LEFT JOIN (
+            SELECT
+                ACCOUNT_ID,
+                COUNT(TRANSACTION_ID) AS TOTAL_TRANSACTIONS,
+                SUM(TRANSACTION_AMOUNT) AS TOTAL_TRANSACTION_AMOUNT,
+                MAX(TRANSACTION_DATE) AS LAST_TRANSACTION_DATE,
+                MAX(CASE WHEN TRANSACTION_DATE >= '2023-10-01' THEN 1 END) AS RECENT_ACTIVITY,
+                MAX(CASE WHEN UPPER(TRANSACTION_TYPE) = 'INCOME' THEN 1 END) AS INCOME_TRANSACTION,
+                AVG(CASE WHEN UPPER(TRANSACTION_TYPE) = 'INCOME' THEN TRANSACTION_AMOUNT END) AS INCOME_AVG_AMOUNT,
+                COUNT(CASE WHEN TRANSACTION_AMOUNT < 0 THEN 1 END) AS DEBIT_TRANSACTION_COUNT,
+                SUM(CASE WHEN TRANSACTION_AMOUNT < 0 THEN TRANSACTION_AMOUNT END) AS TOTAL_DEBIT_AMOUNT,
+                COUNT(CASE WHEN TRANSACTION_AMOUNT > 0 THEN 1 END) AS CREDIT_TRANSACTION_COUNT,
+                SUM(CASE WHEN TRANSACTION_AMOUNT > 0 THEN TRANSACTION_AMOUNT END) AS TOTAL_CREDIT_AMOUNT
+            FROM TRANSACTIONS
+            GROUP BY ACCOUNT_ID
+    ) T ON A.ACCOUNT_ID = T.ACCOUNT_ID
+GROUP BY
+    UC.USER_ID, UC.CONSENT_STATUS;
+
+-- unique index required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS user_activity_summary_user_id_idx ON USER_ACTIVITY_SUMMARY (USER_ID);
+
+-- USER_MONTH_AGGREGATES TABLE SCHEMA (feature store partial aggregates per user, month and transaction type)
+CREATE TABLE IF NOT EXISTS USER_MONTH_AGGREGATES (
+    USER_ID INT NOT NULL,
+    MONTH DATE NOT NULL,
+    TRANSACTION_TYPE VARCHAR(50) NOT NULL,
+    TRANSACTION_COUNT BIGINT NOT NULL,
+    AMOUNT_SUM DECIMAL(20, 2) NOT NULL,
+    INCOME_COUNT BIGINT NOT NULL,
+    EXPENSE_COUNT BIGINT NOT NULL,
+    FEATURE_VERSION INT NOT NULL,
+    PRIMARY KEY (USER_ID, MONTH, TRANSACTION_TYPE)
+    );
+
+-- FEATURE_VERSIONS TABLE SCHEMA (one row per refresh of user_transaction_features)
+CREATE TABLE IF NOT EXISTS FEATURE_VERSIONS (
+    FEATURE_VERSION INT PRIMARY KEY,
+    WINDOW_START DATE,
+    WINDOW_END DATE,
+    LAST_TRANSACTION_ID BIGINT,
+    USERS_UPDATED INT NOT NULL,
+    FULL_REBUILD BOOLEAN NOT NULL,
+    CREATED_AT TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+
+-- KMEANS_SWEEPS TABLE SCHEMA (task3 elbow plot: scores of each k, per feature set and version of the features)
+CREATE TABLE IF NOT EXISTS KMEANS_SWEEPS (
+    FEATURE_SET_HASH TEXT NOT NULL,
+    DATA_VERSION TEXT NOT NULL,
+    METHOD TEXT NOT NULL,
+    K INT NOT NULL,
+    INERTIA DOUBLE PRECISION NOT NULL,
+    SILHOUETTE DOUBLE PRECISION NOT NULL,
+    SILHOUETTE_LOWER DOUBLE PRECISION NOT NULL,
+    SILHOUETTE_UPPER DOUBLE PRECISION NOT NULL,
+    DAVIES_BOULDIN DOUBLE PRECISION NOT NULL,
+    SECONDS DOUBLE PRECISION NOT NULL,
+    CREATED_AT TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (FEATURE_SET_HASH, DATA_VERSION, METHOD, K)
+    );
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# directory shared with the app (docker-compose volume)
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '/snapshots')
+MANIFEST_FILE = 'manifest.json'
+
+# typed snapshot schema of each init.sql table
+SCHEMAS = {
+    'user_consents': pa.schema([('user_id', pa.int32()), ('consent_id', pa.int32()),
+                                ('consent_granted_date', pa.date32()), ('consent_status', pa.string())]),
+    'accounts': pa.schema([('account_id', pa.int32()), ('user_id', pa.int32()), ('account_type', pa.string()),
+                           ('account_status', pa.string()), ('account_balance', pa.float64()),
+                           ('bank_name', pa.string())]),
+    'transactions': pa.schema([('transaction_id', pa.int32()), ('account_id', pa.int32()),
+                               ('transaction_amount', pa.float64()), ('transaction_date', pa.date32()),
+                               ('transaction_type', pa.string())]),
+}
+
+# tables partitioned by month: partition column, date column it is derived from
+PARTITIONS = {'transactions': ('transaction_month', 'transaction_date')}
+
+
+def snapshot_version(cursor):
+    '''
+    Function returns the version of the data in the database: the time of the last load recorded in ingest_state
+    '''
+    cursor.execute("SELECT max(loaded_at)::text FROM ingest_state")
+    return cursor.fetchone()[0]
+
+
+def export_table(connection, table, path, chunk_rows=500000):
+    '''
+    Function writes a table to typed Parquet through a server-side cursor, a chunk of rows at a time
+    :param connection: psycopg2 connection, in the transaction the snapshot is taken in
+    :param table: table name (str)
+    :param path: Parquet file, or dataset directory for the PARTITIONS tables (str)
+    :param chunk_rows: number of rows fetched at once (int)
+    :return: number of rows written (int)
+    '''
+    schema = SCHEMAS[table]
+    # numeric columns as float8, psycopg2 would return them as Decimal objects
+    select = ', '.join(f"{field.name}::float8" if pa.types.is_floating(field.type) else field.name for field in schema)
+    partition = PARTITIONS.get(table)
+    rows, writer = 0, None
+    with connection.cursor(name=f"snapshot_{table}") as cursor:
+        cursor.itersize = chunk_rows
+        cursor.execute(f"SELECT {select} FROM {table}")
+        while True:
+            records = cursor.fetchmany(chunk_rows)
+            if not records:
+                break
+            batch = pa.Table.from_pandas(pd.DataFrame(records, columns=schema.names), schema=schema,
+                                         preserve_index=False)
+            if partition is None:
+                writer = writer or pq.ParquetWriter(path, schema)
+                writer.write_table(batch)
+            else:
+                month = pd.to_datetime(batch[partition[1]].to_pandas()).dt.strftime('%Y-%m')
+                batch = batch.append_column(partition[0], pa.array(month, pa.string()))
+                pq.write_to_dataset(batch, path, partition_cols=[partition[0]],
+                                    basename_template=f"part-{rows}-{{i}}.parquet")
+            rows += len(records)
+    if writer is not None:
+        writer.close()
+    elif partition is None:  # empty table
+        pq.write_table(schema.empty_table(), path)
+    elif rows == 0:  # empty dataset: a single file of the schema and the partition column, without partitions
+        os.makedirs(path, exist_ok=True)
+        pq.write_table(schema.append(pa.field(partition[0], pa.string())).empty_table(),
+                       os.path.join(path, 'part-empty.parquet'))
+    return rows
+
+
+def write_snapshots(connection, snapshot_dir=SNAPSHOT_DIR, keep=2):
+    '''
+    Function writes a consistent Parquet snapshot of every table to a new version directory, then atomically points
+    the manifest at it, so the app never reads a partial snapshot
+    :param connection: psycopg2 connection
+    :param snapshot_dir: snapshot directory shared with the app (str)
+    :param keep: number of snapshot versions kept, older versions may still be read by running apps (int)
+    :return: manifest (dict)
+    '''
+    start = time.perf_counter()
+    directory = time.strftime('%Y%m%dT%H%M%S') + f"-{os.getpid()}"
+    os.makedirs(os.path.join(snapshot_dir, directory))
+    with connection:
+        with connection.cursor() as cursor:
+            # every table and the version are read from the same database snapshot
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            manifest = {'version': snapshot_version(cursor), 'directory': directory, 'tables': {}}
+        for table in SCHEMAS:
+            path = os.path.join(directory, table if table in PARTITIONS else f"{table}.parquet")
+            rows = export_table(connection, table, os.path.join(snapshot_dir, path))
+            manifest['tables'][table] = {'path': path, 'rows': rows,
+                                         'partitioning': PARTITIONS[table][0] if table in PARTITIONS else None}
+
+    tmp_file = os.path.join(snapshot_dir, MANIFEST_FILE + '.tmp')
+    with open(tmp_file, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_file, os.path.join(snapshot_dir, MANIFEST_FILE))
+
+    versions = sorted(entry for entry in os.listdir(snapshot_dir)
+                      if os.path.isdir(os.path.join(snapshot_dir, entry)) and entry != directory)
+    for entry in versions[:max(len(versions) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(snapshot_dir, entry), ignore_errors=True)
+    print(f"Snapshots of {', '.join(SCHEMAS)} written to {snapshot_dir} in {time.perf_counter() - start:.2f} seconds")
+    return manifest